@@ -1,156 +1,289 @@
 import tkinter as tk
 from tkinter import filedialog
-from PIL import Image, ImageTk, ImageDraw, ImageFont
+from dataclasses import replace
+from functools import partial
+from PIL import Image, ImageTk
+
+from render_scheduler import BackgroundRenderer, RenderScheduler
+from watermark_engine import DisplayBuffer, WatermarkRenderer, WatermarkSettings, union_box
+from watermark_export import DEFAULT_PROFILE, PROFILE_NAMES, save_export, streamed_png_options
+from watermark_io import ImageHandle, use_banded_export
+from watermark_recipe import Recipe, load_recipe, save_recipe
+
+PREVIEW_SIZE = (400, 400)  # Maximum size of the editing proxy
+PLACEHOLDER_TEXT = "Enter text here, if using text watermark"
+
+# Users open their own scans and mosaics, which can legitimately exceed Pillow's bomb limit
+Image.MAX_IMAGE_PIXELS = None
 
 def load_image():
     file_path = filedialog.askopenfilename(
         filetypes=[("Image files", "*.jpg;*.jpeg;*.png;*.bmp")]
     )
     if file_path:
-        global base_image, base_image_display, img_tk
-        base_image = Image.open(file_path).convert("RGBA")  # Ensure we use RGBA for transparency
-        base_image.thumbnail((400, 400))  # Resizing for display
+        global original, base_image, base_image_display, proxy_scale, base_tk
+        # Only the header is read here; the full decode waits until export
+        handle = ImageHandle(file_path)
+        if original is not None:
+            original.close()
+        original = handle
+        base_image = original.preview(PREVIEW_SIZE)
+        proxy_scale = original.size[0] / base_image.width
+        if pending_recipe is not None:
+            apply_recipe_geometry()  # Recipe loaded before any image; its scale is known now
         base_image_display = base_image.copy()  # Copy for dynamic overlay
-        img_tk = ImageTk.PhotoImage(base_image_display)
-        image_label.config(image=img_tk)
-        image_label.image = img_tk
-        root.update()
+        base_tk = ImageTk.PhotoImage(base_image)  # Shown under the watermark while dragging
+        show_image(base_image_display)
+        render_scheduler.invalidate()
+        apply_watermark()
 
 def load_watermark_image():
     file_path = filedialog.askopenfilename(
         filetypes=[("PNG files", "*.png")]
     )
     if file_path:
-        global watermark_image, watermark_resized
+        global watermark_image, watermark_path
         watermark_image = Image.open(file_path).convert("RGBA")  # Load PNG with transparency
+        watermark_path = file_path
+        render_scheduler.invalidate()
         apply_watermark()
 
-def apply_watermark():
-    if base_image:
-        if watermark_type.get() == "image":
-            update_image_watermark()
-        elif watermark_type.get() == "text":
-            update_text_watermark()
-
-def update_image_watermark():
-    global base_image_display, watermark_image, watermark_resized, img_tk, watermark_pos
-    base_image_display = base_image.copy()
-
-    # Resize the watermark dynamically based on the slider
-    size_percentage = watermark_size_slider.get() / 100.0
-    watermark_resized = watermark_image.resize(
-        (int(watermark_image.width * size_percentage), int(watermark_image.height * size_percentage)),
-        Image.Resampling.LANCZOS
+def current_settings():
+    """Snapshot the Tk controls into an immutable settings record."""
+    return WatermarkSettings(
+        watermark_type=watermark_type.get(),
+        text=watermark_text.get(),
+        include_copyright=include_copyright.get(),
+        white_text=white_text.get(),
+        opacity=opacity_slider.get(),
+        size=watermark_size_slider.get(),
+        grid_mode=grid_mode.get(),
+        position=watermark_pos,
+        draft=interacting
     )
 
-    # Adjust watermark opacity
-    opacity = int(opacity_slider.get() * 2.55)  # Convert to 0-255 range
-    watermark_with_opacity = watermark_resized.copy()
-    alpha = watermark_with_opacity.split()[3]  # Get the alpha channel
-    alpha = alpha.point(lambda p: p * (opacity / 255))  # Apply opacity
-    watermark_with_opacity.putalpha(alpha)
-
-    if grid_mode.get():
-        # Checkered pattern - alternating image watermarks in a grid
-        spacing_x = watermark_with_opacity.width * 2  # Set spacing between watermarks
-        spacing_y = watermark_with_opacity.height * 2
-
-        for x in range(0, base_image.width, spacing_x):
-            for y in range(0, base_image.height, spacing_y):
-                # Apply watermark on even (x + y) sum positions to create checkered pattern
-                if (x // spacing_x + y // spacing_y) % 2 == 0:
-                    base_image_display.paste(watermark_with_opacity, (x, y), watermark_with_opacity)
-    else:
-        # Single watermark mode - Place one watermark at the current position
-        watermark_pos = (
-            max(0, min(watermark_pos[0], base_image.width - watermark_with_opacity.width)),
-            max(0, min(watermark_pos[1], base_image.height - watermark_with_opacity.height))
-        )
-        base_image_display.paste(watermark_with_opacity, watermark_pos, watermark_with_opacity)
-
-    # Update the display
-    img_tk = ImageTk.PhotoImage(base_image_display)
-    image_label.config(image=img_tk)
-    image_label.image = img_tk
-    root.update()
-
-def update_text_watermark():
-    global base_image_display, img_tk, watermark_pos
-    base_image_display = base_image.copy()
-
-    # Get the user input text
-    text = watermark_text.get()
-
-    # Prepend the copyright symbol if the checkbox is selected
-    if include_copyright.get():
-        text = f"© {text}"
-
-    # Create a blank transparent image to draw the text onto
-    text_image = Image.new("RGBA", (base_image.width, base_image.height), (255, 255, 255, 0))
-
-    # Select font size
-    font_size = watermark_size_slider.get()
-
-    # Set up a font (You can change the font path to any .ttf file you have)
-    try:
-        font = ImageFont.truetype("arial.ttf", font_size)
-    except IOError:
-        font = ImageFont.load_default()  # Fallback to default if font is not found
-
-    # Create a drawing context
-    draw = ImageDraw.Draw(text_image)
-
-    # Adjust text opacity
-    opacity = int(opacity_slider.get() * 2.55)  # Convert to 0-255 range
-
-    # Text color with applied opacity
-    fill_color = (255, 255, 255, opacity) if white_text.get() else (0, 0, 0, opacity)
-
-    # Get the bounding box of the text to calculate dimensions
-    text_bbox = draw.textbbox((0, 0), text, font=font)
-    text_width = text_bbox[2] - text_bbox[0]
-    text_height = text_bbox[3] - text_bbox[1]
-
-    if grid_mode.get():
-        # Checkered pattern - alternating text watermarks in a grid
-        spacing_x = text_width * 2  # Set spacing between watermarks
-        spacing_y = text_height * 2
-
-        for x in range(0, base_image.width, spacing_x):
-            for y in range(0, base_image.height, spacing_y):
-                # Apply text on odd (x + y) sum positions to create checkered pattern
-                if (x // spacing_x + y // spacing_y) % 2 != 0:
-                    draw.text((x, y), text, font=font, fill=fill_color)
-    else:
-        # Single watermark mode - Place text at the current position
-        draw.text(watermark_pos, text, font=font, fill=fill_color)
-
-    # Composite the text image over the base image
-    base_image_display = Image.alpha_composite(base_image_display, text_image)
+def apply_watermark():
+    """Request a preview render; bursts of events collapse into one render when idle."""
+    render_scheduler.request()
 
-    # Update the display
-    img_tk = ImageTk.PhotoImage(base_image_display)
-    image_label.config(image=img_tk)
-    image_label.image = img_tk
-    root.update()
+def render_preview(settings):
+    global watermark_pos
+    if base_image:
+        # Keep the drag position in sync with where the image watermark will be clamped to
+        if settings.watermark_type == "image" and watermark_image and not settings.grid_mode:
+            watermark_pos = ui_renderer.image_position(settings, base_image.size, watermark_image)
+
+        # Render off the Tk thread; only the newest request is kept
+        image, watermark, generation = base_image, watermark_image, drag_generation
+        background_renderer.submit(lambda: render_frame(settings, image, watermark, generation))
+
+def render_frame(settings, image, watermark, generation):
+    """Runs on the render worker: update the preview buffer and cut out what changed."""
+    global pending_box
+    dirty_box = display_buffer.update(settings, image, watermark)
+    pending_box = union_box(pending_box, dirty_box)
+    if background_renderer.superseded():
+        return None  # The next render delivers the accumulated change
+    if pending_box is None:
+        return None, None, display_buffer.image.size, generation  # Nothing changed, but the frame is current
+    box, pending_box = pending_box, None
+    return display_buffer.image.crop(box), box, display_buffer.image.size, generation
+
+def show_frame(result):
+    """Runs on the Tk thread with a finished render from the worker."""
+    patch, box, frame_size, generation = result
+    # Only a render requested after the last drag ended replaces the drag sprite;
+    # older ones still land in the frame, which stays hidden behind it
+    if not dragging and generation == drag_generation:
+        hide_drag_sprite()
+    if patch is not None:
+        show_image(patch, box, frame_size)
+
+def show_image(image, box=None, frame_size=None):
+    """Update the display surface in place.
+
+    image is either the whole frame or, when box is given, just the part of
+    the frame at box. The Tk photo is only recreated when the frame size
+    changes; otherwise its pixels are overwritten, so long editing sessions
+    do not keep allocating new photos.
+    """
+    global img_tk, patch_tk
+    frame_size = frame_size or image.size
+    if img_tk is None or (img_tk.width(), img_tk.height()) != frame_size:
+        img_tk = ImageTk.PhotoImage(image)  # A new frame size always comes with a full frame
+        if drag_sprite_tk is None:  # Otherwise hide_drag_sprite() shows it
+            preview_canvas.itemconfig(frame_item, image=img_tk)
+        preview_canvas.config(width=frame_size[0], height=frame_size[1])
+    elif box is None or image.size == frame_size:
+        img_tk.paste(image)
+    else:
+        # Stage the patch in the corner of a frame-sized photo, then copy it into
+        # place. The staging photo only changes with the frame size, not with
+        # every patch size, so scrubbing the size slider allocates nothing.
+        if patch_tk is None or (patch_tk.width(), patch_tk.height()) != frame_size:
+            patch_tk = ImageTk.PhotoImage(image.mode, frame_size)
+        patch_tk.paste(image)  # Writes from the top-left corner
+        # "set" replaces the pixels instead of blending the patch over the old frame
+        root.tk.call(str(img_tk), "copy", str(patch_tk), "-from", 0, 0, image.width, image.height,
+                     "-to", box[0], box[1], "-compositingrule", "set")
 
 def save_image():
     """Save the final image with the watermark."""
     file_path = filedialog.asksaveasfilename(
         defaultextension=".png",
-        filetypes=[("PNG files", "*.png"), ("JPEG files", "*.jpg;*.jpeg"), ("BMP files", "*.bmp")]
+        filetypes=[("PNG files", "*.png"), ("JPEG files", "*.jpg;*.jpeg"), ("WebP files", "*.webp"),
+                   ("BMP files", "*.bmp")]
     )
     if file_path:
-        base_image_display.save(file_path)
+        # Re-render the recipe against the full-resolution original instead of the preview
+        settings = replace(current_settings(), draft=False).scaled(proxy_scale)
+        profile = export_profile.get()
+        # Full-resolution sprites and layers would evict the preview's and stay
+        # cached long after the export, so they go in caches dropped with it
+        export_renderer = WatermarkRenderer(fonts=ui_renderer.fonts)
+        if use_banded_export(original.size, file_path):
+            # Too large to hold several copies of; render and encode in bands. Only
+            # uncompressed originals are also read band by band, others decode once
+            draw = partial(export_renderer.render_band, settings, watermark_image=watermark_image)
+            original.export_banded(file_path, draw, **streamed_png_options(profile))
+        else:
+            try:
+                export_image = export_renderer.render(settings, original.full(), watermark_image)
+                save_export(export_image, file_path, profile=profile)  # Converts the mode as the format needs
+            finally:
+                original.release()  # Only the preview stays in memory between exports
         print(f"Image saved to {file_path}")
 
+def save_recipe_file():
+    """Save the current watermark configuration as a recipe file."""
+    file_path = filedialog.asksaveasfilename(
+        defaultextension=".json",
+        filetypes=[("Watermark recipes", "*.json")]
+    )
+    if file_path:
+        # Recipes are stored in full-resolution units with the position relative to the image
+        settings = replace(current_settings(), draft=False).scaled(proxy_scale)
+        if settings.text == PLACEHOLDER_TEXT:
+            settings = replace(settings, text="")
+        image_size = original.size if original else PREVIEW_SIZE
+        save_recipe(Recipe.from_settings(settings, image_size, watermark_path), file_path)
+        print(f"Recipe saved to {file_path}")
+
+def load_recipe_file():
+    """Load a recipe file into the controls."""
+    file_path = filedialog.askopenfilename(
+        filetypes=[("Watermark recipes", "*.json")]
+    )
+    if file_path:
+        global watermark_image, watermark_path, pending_recipe
+        try:
+            recipe = load_recipe(file_path)
+            if recipe.watermark_image:
+                watermark_image = Image.open(recipe.watermark_image).convert("RGBA")
+                watermark_path = recipe.watermark_image
+        except (OSError, ValueError) as error:
+            print(f"Could not load recipe {file_path}: {error}")
+            return
+
+        settings = recipe.settings
+        watermark_type.set(settings.watermark_type)
+        include_copyright.set(settings.include_copyright)
+        white_text.set(settings.white_text)
+        opacity_slider.set(settings.opacity)
+        grid_mode.set(settings.grid_mode)
+        if settings.text:
+            watermark_entry.config(fg="black")
+            watermark_text.set(settings.text)
+        else:
+            watermark_text.set("")
+            add_placeholder(None)
+        # Size and position depend on the image; without one they wait for load_image
+        pending_recipe = recipe
+        if base_image:
+            apply_recipe_geometry()
+
+        render_scheduler.invalidate()
+        apply_watermark()
+
+def apply_recipe_geometry():
+    """Apply the pending recipe's size and position in proxy units of the open image."""
+    global watermark_pos, pending_recipe
+    settings = pending_recipe.settings_for(base_image.size)
+    watermark_size_slider.set(round(settings.size / proxy_scale))  # Back to proxy units
+    watermark_pos = settings.position
+    pending_recipe = None
+
+def begin_interaction(event):
+    """Render cheap drafts while a slider is being dragged."""
+    global interacting
+    interacting = True
+
+def end_interaction(event):
+    """Re-render at full quality once the mouse button is released."""
+    global interacting
+    interacting = False
+    if drag_sprite_tk is not None:
+        # Always composite after a drag, even if the watermark did not move
+        render_scheduler.invalidate()
+    apply_watermark()
+
 def start_drag(event):
     # When mouse is clicked, start drag
-    global drag_data
+    global drag_data, dragging
+    dragging = True
+    begin_interaction(event)
     drag_data["start_x"] = event.x
     drag_data["start_y"] = event.y
     drag_data["start_pos_x"] = watermark_pos[0]
     drag_data["start_pos_y"] = watermark_pos[1]
+    show_drag_sprite()
+
+def end_drag(event):
+    """Finish a drag; renders requested from now on may replace the drag sprite."""
+    global dragging, drag_generation
+    dragging = False
+    drag_generation += 1
+    end_interaction(event)
+
+def show_drag_sprite():
+    """Show the plain base with the watermark as its own canvas item, so dragging
+    only moves the item and the real composite happens once on release."""
+    global drag_sprite_tk
+    settings = replace(current_settings(), draft=False)
+    if not base_image or settings.grid_mode:
+        return
+    if settings.watermark_type == "image":
+        if watermark_image is None:
+            return
+        sprite, offset = ui_renderer.image_sprite(settings, watermark_image), (0, 0)
+    else:
+        sprite, offset = ui_renderer.text_sprite(settings)
+    if sprite.width == 0 or sprite.height == 0:
+        return
+
+    drag_data["sprite_offset"] = offset
+    drag_data["sprite_size"] = sprite.size
+    drag_sprite_tk = ImageTk.PhotoImage(sprite)
+    preview_canvas.itemconfig(frame_item, image=base_tk)
+    preview_canvas.itemconfig(sprite_item, image=drag_sprite_tk, state="normal")
+    move_drag_sprite()
+
+def move_drag_sprite():
+    """Place the drag sprite where the renderer would draw the watermark."""
+    if watermark_type.get() == "image":
+        x, y = ui_renderer.clamp_position(watermark_pos, base_image.size, drag_data["sprite_size"])
+    else:
+        x = watermark_pos[0] + drag_data["sprite_offset"][0]
+        y = watermark_pos[1] + drag_data["sprite_offset"][1]
+    preview_canvas.coords(sprite_item, x, y)
+
+def hide_drag_sprite():
+    """Go back to showing the composited frame."""
+    global drag_sprite_tk
+    if drag_sprite_tk is not None:
+        preview_canvas.itemconfig(sprite_item, state="hidden", image="")
+        preview_canvas.itemconfig(frame_item, image=img_tk)
+        drag_sprite_tk = None
 
 def on_drag(event):
     # When the mouse is moved with button held down, calculate position offset
@@ -166,19 +299,20 @@ def on_drag(event):
     new_x = max(0, min(new_x, base_image.width))
     new_y = max(0, min(new_y, base_image.height))
 
-    # Update the watermark position and refresh the image
+    # Update the watermark position; the composite is redone when the drag ends
     watermark_pos = (new_x, new_y)
-    apply_watermark()
+    if drag_sprite_tk is not None:
+        move_drag_sprite()
 
 def add_placeholder(event):
     """Adds placeholder text when the entry is empty."""
     if watermark_text.get() == "":
         watermark_entry.config(fg="grey")
-        watermark_text.set("Enter text here, if using text watermark")
+        watermark_text.set(PLACEHOLDER_TEXT)
 
 def remove_placeholder(event):
     """Removes placeholder text when the user clicks on the entry."""
-    if watermark_text.get() == "Enter text here, if using text watermark":
+    if watermark_text.get() == PLACEHOLDER_TEXT:
         watermark_entry.config(fg="black")
         watermark_text.set("")
 
@@ -189,9 +323,11 @@ root.title("Siris Watermarker")
 # Set the initial size of the window (width x height)
 root.geometry("600x800")
 
-# Label to display the image
-image_label = tk.Label(root)
-image_label.pack()
+# Canvas to display the image
+preview_canvas = tk.Canvas(root, width=PREVIEW_SIZE[0], height=PREVIEW_SIZE[1], highlightthickness=0)
+preview_canvas.pack()
+frame_item = preview_canvas.create_image(0, 0, anchor="nw")  # Composited frame
+sprite_item = preview_canvas.create_image(0, 0, anchor="nw", state="hidden")  # Watermark while dragging
 
 # Button to load the image
 load_button = tk.Button(root, text="Load Image", command=load_image)
@@ -212,7 +348,7 @@ watermark_entry = tk.Entry(text_frame, textvariable=watermark_text, width=40)
 watermark_entry.pack(side="left", padx=5)
 
 # Set the placeholder initially
-watermark_text.set("Enter text here, if using text watermark")
+watermark_text.set(PLACEHOLDER_TEXT)
 watermark_entry.config(fg="grey")
 
 # Bind focus events for placeholder text
@@ -258,24 +394,71 @@ grid_mode = tk.BooleanVar()  # Variable to track the checkbox state
 grid_checkbox = tk.Checkbutton(root, text="Multiple Tile Grid Mode", variable=grid_mode, command=apply_watermark)
 grid_checkbox.pack(pady=5)
 
+# Frame to hold the save button and the export profile
+save_frame = tk.Frame(root)
+save_frame.pack(pady=5)
+
 # Button to save the image
-save_button = tk.Button(root, text="Save Image", command=save_image)
-save_button.pack(pady=5)
+save_button = tk.Button(save_frame, text="Save Image", command=save_image)
+save_button.pack(side="left", padx=5)
+
+# Encoder settings used for the saved file: faster encodes or smaller files
+export_profile = tk.StringVar(value=DEFAULT_PROFILE)
+export_profile_menu = tk.OptionMenu(save_frame, export_profile, *PROFILE_NAMES)
+export_profile_menu.pack(side="left", padx=5)
+
+# Frame to hold the recipe buttons
+recipe_frame = tk.Frame(root)
+recipe_frame.pack(pady=5)
+
+# Buttons to save and load the whole watermark configuration
+save_recipe_button = tk.Button(recipe_frame, text="Save Recipe", command=save_recipe_file)
+save_recipe_button.pack(side="left", padx=5)
+load_recipe_button = tk.Button(recipe_frame, text="Load Recipe", command=load_recipe_file)
+load_recipe_button.pack(side="left", padx=5)
 
 # Variables to hold images
-base_image = None
+original = None  # ImageHandle of the loaded file, decoded in full only for export
+base_image = None  # Editing proxy shown in the preview
 base_image_display = None
 watermark_image = None
-watermark_resized = None
-img_tk = None
+watermark_path = None  # File the watermark image was loaded from, for recipes
+img_tk = None  # Persistent display surface
+patch_tk = None  # Frame-sized staging photo for partial updates
+base_tk = None
+drag_sprite_tk = None
+proxy_scale = 1.0  # Full-resolution pixels per proxy pixel
+pending_recipe = None  # Recipe whose size and position wait for an image
+
+# Headless renderer that does the actual compositing, and the preview frame it patches.
+# Both are used by the render worker; the Tk thread gets its own renderer for drag
+# sprites because the caches are not safe to share across threads. Exports use a
+# throwaway renderer per save.
+renderer = WatermarkRenderer()
+display_buffer = DisplayBuffer(renderer)
+ui_renderer = WatermarkRenderer()
+pending_box = None  # Changed area not yet sent to the display
+background_renderer = BackgroundRenderer(root, show_frame)
+
+# Skips renders when the controls have not changed, e.g. when hovering over a slider
+render_scheduler = RenderScheduler(root, current_settings, render_preview)
 
 # Variables to hold drag data and watermark position
 drag_data = {"start_x": 0, "start_y": 0, "start_pos_x": 0, "start_pos_y": 0}
 watermark_pos = (0, 0)  # Initial watermark position at the top-left corner
-
-# Binding the dragging events to the image label
-image_label.bind("<Button-1>", start_drag)
-image_label.bind("<B1-Motion>", on_drag)
+interacting = False  # True while a mouse button is held on the preview or a slider
+dragging = False  # True while the watermark is being dragged on the preview
+drag_generation = 0  # Number of finished drags, to tell renders requested before the last one
+
+# Binding the dragging events to the preview canvas
+preview_canvas.bind("<Button-1>", start_drag)
+preview_canvas.bind("<B1-Motion>", on_drag)
+preview_canvas.bind("<ButtonRelease-1>", end_drag)
+
+# Sliders render drafts while held and full quality on release
+for slider in (opacity_slider, watermark_size_slider):
+    slider.bind("<ButtonPress-1>", begin_interaction, add="+")
+    slider.bind("<ButtonRelease-1>", end_interaction, add="+")
 
 # Start the main loop
 root.mainloop()
@@ -0,0 +1,127 @@
+"""Scheduling of preview renders for the Siris Watermarker GUI.
+
+Kept free of tkinter imports: these classes only need a widget that offers
+after() and after_idle(), so they can be driven by any Tk widget.
+"""
+import queue
+import threading
+import traceback
+
+
+class RenderScheduler:
+    """Coalesces render requests into at most one render per idle cycle.
+
+    request() can be bound directly to widget events. The first request in a
+    burst schedules a single after_idle() callback; when it runs, snapshot()
+    is taken and render(snapshot) is only called if the snapshot differs
+    from the one rendered last time.
+    """
+
+    def __init__(self, widget, snapshot, render):
+        self.widget = widget
+        self.snapshot = snapshot
+        self.render = render
+        self._pending = False
+        self._last = None
+        self._has_last = False
+        self.renders = 0
+        self.skipped = 0
+
+    def request(self, *args):
+        """Ask for a render on the next idle cycle; extra arguments are ignored."""
+        if not self._pending:
+            self._pending = True
+            self.widget.after_idle(self._run)
+
+    def invalidate(self):
+        """Force the next render even if the snapshot has not changed.
+
+        Needed when something outside the snapshot, such as a newly loaded
+        image, affects the result.
+        """
+        self._has_last = False
+        self._last = None
+
+    def _run(self):
+        self._pending = False
+        state = self.snapshot()
+        if self._has_last and state == self._last:
+            self.skipped += 1
+            return
+        self._last = state
+        self._has_last = True
+        self.renders += 1
+        self.render(state)
+
+
+class BackgroundRenderer:
+    """Runs render jobs on a worker thread, newest request wins.
+
+    submit() replaces any job that has not started yet, so a burst of drag
+    events collapses into the most recent one. A job that is already running
+    cannot be interrupted, but it can poll superseded() to stop early or to
+    skip producing output nobody will see. Results are handed back to the
+    Tk thread by polling from widget.after(), because Tk must only be touched
+    from the thread that created it. Polling only runs while a job is
+    waiting, running or has a result to deliver, so an idle window never
+    wakes up. submit() must be called from the Tk thread.
+    """
+
+    def __init__(self, widget, on_result, poll_interval=16):
+        self.widget = widget
+        self.on_result = on_result
+        self.poll_interval = poll_interval  # Milliseconds, ~60 Hz by default
+        self._condition = threading.Condition()
+        self._job = None
+        self._running = False
+        self._polling = False  # Only touched on the Tk thread
+        self._results = queue.Queue()
+        self._thread = threading.Thread(target=self._work, name="render-worker", daemon=True)
+        self._thread.start()
+
+    def submit(self, job):
+        """Queue job() to run on the worker, dropping any job still waiting."""
+        with self._condition:
+            self._job = job
+            self._condition.notify()
+        if not self._polling:
+            self._polling = True
+            self.widget.after(self.poll_interval, self._poll)
+
+    def superseded(self):
+        """True when a newer job was submitted after the running one."""
+        with self._condition:
+            return self._job is not None
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while self._job is None:
+                    self._condition.wait()
+                job, self._job = self._job, None
+                self._running = True
+            try:
+                result = job()
+            except Exception:
+                traceback.print_exc()
+                result = None
+            if result is not None:
+                self._results.put(result)
+            # Cleared only after the result is queued, so _poll cannot stop before delivering it
+            with self._condition:
+                self._running = False
+
+    def _poll(self):
+        # Deliver results in order; each one is a complete update on its own
+        while True:
+            try:
+                result = self._results.get_nowait()
+            except queue.Empty:
+                break
+            self.on_result(result)
+        with self._condition:
+            busy = self._job is not None or self._running
+        if busy or not self._results.empty():
+            self.widget.after(self.poll_interval, self._poll)
+        else:
+            self._polling = False
@@ -0,0 +1,178 @@
+"""Command line entry point for headless watermarking.
+
+    python siris_watermark.py batch --in photos/ --out watermarked/ --recipe recipe.json --jobs 8
+    python siris_watermark.py batch --in maps/ --out watermarked/ --recipe recipe.json --max-pixels 0
+    python siris_watermark.py pipeline --in photos/ --out watermarked/ --recipe recipe.json --render 6
+    python siris_watermark.py watch --in dropbox/ --out watermarked/ --recipe recipe.json
+    python siris_watermark.py serve --recipe recipe.json --port 8080
+    python siris_watermark.py loadtest --image sample.jpg --requests 500 --concurrency 16
+    python siris_watermark.py benchmark --in reference/ --recipe recipe.json --formats png,jpeg,webp
+
+Rendering goes through the same WatermarkRenderer as the GUI, so a recipe
+produces the same text, image and grid watermarks without a display.
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+from watermark_export import DEFAULT_PROFILE, PROFILE_NAMES, benchmark_profiles
+from watermark_io import to_native
+from watermark_jobs import find_images, init_worker, render_image, validate_recipe, watermark_file
+from watermark_pipeline import STAGES, run_pipeline
+from watermark_server import run_loadtest, run_serve
+from watermark_watch import run_watch
+
+
+def check_recipe(path):
+    """Load a recipe up front so a bad file fails once instead of in every worker."""
+    try:
+        return validate_recipe(path)
+    except (OSError, ValueError) as error:
+        print(f"Invalid recipe {path}: {error}", file=sys.stderr)
+        return None
+
+
+def run_recipe_command(command):
+    """Wrap a command so its recipe is validated before any workers start."""
+    def run(args):
+        if check_recipe(args.recipe) is None:
+            return 2
+        return command(args)
+    return run
+
+
+def run_batch(args):
+    os.makedirs(args.output_dir, exist_ok=True)
+    inputs = find_images(args.input_dir)
+    outputs = [os.path.join(args.output_dir, os.path.basename(path)) for path in inputs]
+    if not inputs:
+        print(f"No images found in {args.input_dir}")
+        return 0
+
+    jobs = args.jobs or os.cpu_count()
+    failures = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(
+        max_workers=jobs, initializer=init_worker, initargs=(args.recipe, args.profile, args.max_pixels)
+    ) as executor:
+        # Hand out files in chunks so tiny images are not dominated by IPC
+        chunksize = max(1, len(inputs) // (jobs * 4))
+        for in_path, error, seconds in executor.map(watermark_file, inputs, outputs, chunksize=chunksize):
+            if error:
+                failures += 1
+                print(f"FAILED {in_path}: {error}", file=sys.stderr)
+            elif args.verbose:
+                print(f"{in_path} ({seconds * 1000:.0f} ms)")
+
+    elapsed = time.perf_counter() - start
+    done = len(inputs) - failures
+    print(f"Watermarked {done}/{len(inputs)} images in {elapsed:.1f}s ({len(inputs) / elapsed:.1f} images/s)")
+    return 1 if failures else 0
+
+
+def run_benchmark(args):
+    inputs = find_images(args.input_dir)
+    if not inputs:
+        print(f"No images found in {args.input_dir}")
+        return 0
+    # Time what an export actually encodes: the watermarked render
+    init_worker(args.recipe)
+    images = []
+    for path in inputs:
+        with Image.open(path) as image:
+            images.append(render_image(to_native(image)))
+    megapixels = sum(image.width * image.height for image in images) / 1e6
+    formats = [name.strip().upper() for name in args.formats.split(",")]
+    print(f"{len(images)} images, {megapixels:.1f} MP, {args.threads} thread(s), best of {args.repeat}")
+
+    results = list(benchmark_profiles(images, formats, args.repeat, args.threads))
+    baseline = {image_format: size for image_format, profile, seconds, size in results if profile == DEFAULT_PROFILE}
+    print(f"{'format':<8}{'profile':<10}{'ms/MP':>8}{'MB':>9}{'bytes':>8}")
+    for image_format, profile, seconds, size in results:
+        relative = size / baseline[image_format] - 1
+        print(f"{image_format:<8}{profile:<10}{seconds * 1000 / megapixels:>8.0f}"
+              f"{size / 1e6:>9.2f}{relative:>+8.0%}")
+    return 0
+
+
+MAX_PIXELS_HELP = "largest input image in pixels, 0 for no limit (default: Pillow's decompression bomb limit)"
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="siris-watermark", description="Headless Siris Watermarker")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    batch = commands.add_parser("batch", help="watermark every image in a directory")
+    batch.add_argument("--in", dest="input_dir", required=True, help="directory of images to watermark")
+    batch.add_argument("--out", dest="output_dir", required=True, help="directory for the results")
+    batch.add_argument("--recipe", required=True, help="JSON recipe describing the watermark")
+    batch.add_argument("--jobs", type=int, default=os.cpu_count(), help="worker processes (default: all cores)")
+    batch.add_argument("--profile", choices=PROFILE_NAMES, default=DEFAULT_PROFILE, help="export encoder profile")
+    batch.add_argument("--max-pixels", type=int, help=MAX_PIXELS_HELP)
+    batch.add_argument("-v", "--verbose", action="store_true", help="print every file as it finishes")
+    batch.set_defaults(func=run_recipe_command(run_batch))
+
+    watch = commands.add_parser("watch", help="watermark images as they appear in a directory")
+    watch.add_argument("--in", dest="input_dir", required=True, help="hot folder to watch")
+    watch.add_argument("--out", dest="output_dir", required=True, help="directory for the results")
+    watch.add_argument("--recipe", required=True, help="JSON recipe describing the watermark")
+    watch.add_argument("--jobs", type=int, default=os.cpu_count(), help="worker processes (default: all cores)")
+    watch.add_argument("--interval", type=float, default=1.0, help="seconds between directory scans")
+    watch.add_argument("--settle", type=float, default=2.0,
+                       help="seconds a file must be unchanged before it is processed")
+    watch.add_argument("--profile", choices=PROFILE_NAMES, default=DEFAULT_PROFILE, help="export encoder profile")
+    watch.add_argument("--max-pixels", type=int, help=MAX_PIXELS_HELP)
+    watch.add_argument("--once", action="store_true", help="process what is ready, then exit")
+    watch.set_defaults(func=run_recipe_command(run_watch))
+
+    pipeline = commands.add_parser("pipeline", help="watermark a directory with overlapping I/O and CPU stages")
+    pipeline.add_argument("--in", dest="input_dir", required=True, help="directory of images to watermark")
+    pipeline.add_argument("--out", dest="output_dir", required=True, help="directory for the results")
+    pipeline.add_argument("--recipe", required=True, help="JSON recipe describing the watermark")
+    for stage in STAGES:
+        pipeline.add_argument(f"--{stage}", type=int, help=f"concurrent {stage} workers")
+    pipeline.add_argument("--queue-size", type=int, default=8, help="capacity of the queue in front of each stage")
+    pipeline.add_argument("--profile", choices=PROFILE_NAMES, default=DEFAULT_PROFILE, help="export encoder profile")
+    pipeline.set_defaults(func=run_recipe_command(run_pipeline))
+
+    serve = commands.add_parser("serve", help="run a local HTTP watermarking service")
+    serve.add_argument("--recipe", required=True, help="JSON recipe applied to every request")
+    serve.add_argument("--host", default="127.0.0.1", help="address to listen on (default: localhost only)")
+    serve.add_argument("--port", type=int, default=8080, help="port to listen on")
+    serve.add_argument("--jobs", type=int, default=os.cpu_count(), help="render worker processes")
+    serve.add_argument("--max-body-mb", type=int, default=100, help="largest accepted upload")
+    serve.add_argument("--profile", choices=PROFILE_NAMES, default=DEFAULT_PROFILE,
+                       help="export encoder profile, unless a request asks for another")
+    serve.add_argument("--quiet", action="store_true", help="do not log every request")
+    serve.set_defaults(func=run_recipe_command(run_serve))
+
+    loadtest = commands.add_parser("loadtest", help="measure throughput and latency of a running service")
+    loadtest.add_argument("--url", default="http://127.0.0.1:8080/watermark", help="service endpoint")
+    loadtest.add_argument("--image", required=True, help="image file to send with every request")
+    loadtest.add_argument("--requests", type=int, default=200, help="total number of requests")
+    loadtest.add_argument("--concurrency", type=int, default=8, help="parallel connections")
+    loadtest.add_argument("--recipe-header", help="recipe file to send in X-Watermark-Recipe")
+    loadtest.add_argument("--timeout", type=float, default=60.0, help="per-request timeout in seconds")
+    loadtest.set_defaults(func=run_loadtest)
+
+    benchmark = commands.add_parser("benchmark", help="measure encode time and size of every export profile")
+    benchmark.add_argument("--in", dest="input_dir", required=True, help="directory of reference images")
+    benchmark.add_argument("--recipe", required=True, help="JSON recipe applied before encoding")
+    benchmark.add_argument("--formats", default="png,jpeg,webp", help="comma separated output formats")
+    benchmark.add_argument("--repeat", type=int, default=3, help="runs per encode; the fastest counts")
+    benchmark.add_argument("--threads", type=int, default=1, help="PNG compression threads")
+    benchmark.set_defaults(func=run_recipe_command(run_benchmark))
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,48 @@
+"""Grid-mode rendering checks for watermark_engine."""
+import pytest
+from PIL import Image, ImageDraw
+
+from watermark_engine import WatermarkRenderer, WatermarkSettings
+
+CASES = [(text, size) for text in ("Hello", "...", "---", "-", "_", "jy") for size in (7, 20, 60)]
+
+
+def reference_text_grid(renderer, settings, base_image):
+    """The per-cell draw.text loop grid mode used before it was tiled."""
+    text_image = Image.new("RGBA", base_image.size, (255, 255, 255, 0))
+    draw = ImageDraw.Draw(text_image)
+    font = renderer.fonts.get(settings.font_size)
+    text_bbox = draw.textbbox((0, 0), settings.display_text, font=font)
+    spacing_x = (text_bbox[2] - text_bbox[0]) * 2
+    spacing_y = (text_bbox[3] - text_bbox[1]) * 2
+    for x in range(0, base_image.width, spacing_x):
+        for y in range(0, base_image.height, spacing_y):
+            if (x // spacing_x + y // spacing_y) % 2 != 0:
+                draw.text((x, y), settings.display_text, font=font, fill=settings.text_color)
+    return Image.alpha_composite(base_image, text_image)
+
+
+def text_grid_settings(text, size):
+    return WatermarkSettings(watermark_type="text", text=text, opacity=80, size=size, grid_mode=True)
+
+
+@pytest.mark.parametrize("text, size", CASES)
+def test_text_grid_matches_per_cell_loop(text, size):
+    renderer = WatermarkRenderer()
+    settings = text_grid_settings(text, size)
+    base_image = Image.new("RGBA", (301, 211), (90, 140, 200, 255))
+    expected = reference_text_grid(renderer, settings, base_image)
+    assert renderer.render(settings, base_image).tobytes() == expected.tobytes()
+
+
+@pytest.mark.parametrize("text, size", CASES)
+def test_text_grid_bands_match_full_render(text, size):
+    renderer = WatermarkRenderer()
+    settings = text_grid_settings(text, size)
+    base_image = Image.new("RGBA", (301, 211), (90, 140, 200, 255))
+    expected = renderer.render(settings, base_image)
+    for band_height in (1, 13, 64):
+        for top in range(0, base_image.height, band_height):
+            band = base_image.crop((0, top, base_image.width, min(top + band_height, base_image.height)))
+            renderer.render_band(settings, band, top, base_image.size)
+            assert band.tobytes() == expected.crop((0, top) + (base_image.width, top + band.height)).tobytes()
@@ -0,0 +1,122 @@
+"""Round-trip checks for the streaming PNG encoder in watermark_io."""
+import io
+import random
+import zlib
+
+import pytest
+from PIL import Image, ImageCms
+
+from watermark_io import PNG_BLOCK_BYTES, PngWriter, export_banded, save_png
+
+SRGB = ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB")).tobytes()
+
+
+def noisy_image(mode, size=(97, 61)):
+    rng = random.Random(0)
+    bands = len(mode)
+    data = rng.randbytes(size[0] * size[1] * bands)
+    image = Image.frombytes(mode, size, data)
+    image.info["icc_profile"] = SRGB
+    image.info["dpi"] = (300, 300)
+    return image
+
+
+def assert_round_trip(source, data):
+    with Image.open(io.BytesIO(data)) as result:
+        result.load()
+        assert result.format == "PNG"
+        assert result.mode == source.mode
+        assert result.tobytes() == source.tobytes()
+        assert result.info.get("icc_profile") == SRGB
+        assert result.info["dpi"] == pytest.approx((300, 300), abs=0.1)
+
+
+@pytest.mark.parametrize("mode", ["L", "LA", "RGB", "RGBA"])
+@pytest.mark.parametrize("threads", [1, 3])
+def test_save_png_round_trip(mode, threads):
+    source = noisy_image(mode)
+    buffer = io.BytesIO()
+    save_png(source, buffer, compress_level=6, threads=threads)
+    assert_round_trip(source, buffer.getvalue())
+
+
+@pytest.mark.parametrize("png_filter", ["none", "sub", "up", "average"])
+@pytest.mark.parametrize("mode", ["L", "RGB", "RGBA"])
+def test_png_filters_round_trip(png_filter, mode):
+    source = noisy_image(mode, (33, 300))
+    buffer = io.BytesIO()
+    with PngWriter(buffer, source.size, mode, png_filter=png_filter) as writer:
+        for top in range(0, source.height, 128):
+            writer.write(source.crop((0, top, source.width, min(top + 128, source.height))))
+    with Image.open(io.BytesIO(buffer.getvalue())) as result:
+        assert result.tobytes() == source.tobytes()
+
+
+def idat_chunks(data):
+    chunks, position = [], 8
+    while position < len(data):
+        length = int.from_bytes(data[position:position + 4], "big")
+        if data[position + 4:position + 8] == b"IDAT":
+            chunks.append(data[position + 8:position + 8 + length])
+        position += length + 12
+    return chunks
+
+
+@pytest.mark.parametrize("png_filter", ["none", "up"])
+def test_multi_block_round_trip(png_filter):
+    # A random run repeated every 20000 bytes: deflate matches reach back across
+    # block boundaries, so every block depends on the dictionary it was primed with
+    rng = random.Random(1)
+    size = (1000, 1100)
+    run = rng.randbytes(20000)
+    data = (run * (size[0] * size[1] * 4 // len(run) + 1))[:size[0] * size[1] * 4]
+    source = Image.frombytes("RGBA", size, data)
+    source.info.update(icc_profile=SRGB, dpi=(300, 300))
+    assert size[0] * size[1] * 4 >= 3 * PNG_BLOCK_BYTES
+    buffer = io.BytesIO()
+    with PngWriter(buffer, size, "RGBA", threads=4, icc_profile=SRGB, dpi=(300, 300),
+                   png_filter=png_filter) as writer:
+        for top in range(0, size[1], 333):  # Bands that do not line up with blocks
+            writer.write(source.crop((0, top, size[0], min(top + 333, size[1]))))
+    chunks = idat_chunks(buffer.getvalue())
+    assert len(chunks) >= 3
+    # zlib checks the joined stream's adler32, which Pillow's decoder does not
+    rows = zlib.decompress(b"".join(chunks))
+    assert len(rows) == (size[0] * 4 + 1) * size[1]
+    assert_round_trip(source, buffer.getvalue())
+
+
+def test_writer_rejects_unknown_filter():
+    with pytest.raises(ValueError):
+        PngWriter(io.BytesIO(), (4, 4), "RGB", png_filter="paeth")
+
+
+def test_writer_without_metadata_writes_no_ancillary_chunks():
+    source = noisy_image("RGB")
+    buffer = io.BytesIO()
+    with PngWriter(buffer, source.size, "RGB") as writer:
+        writer.write(source)
+    data = buffer.getvalue()
+    assert b"iCCP" not in data and b"pHYs" not in data
+    with Image.open(io.BytesIO(data)) as result:
+        assert result.tobytes() == source.tobytes()
+
+
+def test_writer_accepts_several_bands():
+    source = noisy_image("RGBA", (40, 1000))
+    buffer = io.BytesIO()
+    with PngWriter(buffer, source.size, "RGBA", threads=2,
+                   icc_profile=SRGB, dpi=(300, 300)) as writer:
+        for top in range(0, source.height, 170):
+            writer.write(source.crop((0, top, source.width, min(top + 170, source.height))))
+    assert_round_trip(source, buffer.getvalue())
+
+
+def test_export_banded_keeps_source_metadata(tmp_path):
+    source = noisy_image("RGB", (64, 300))
+    in_path = tmp_path / "in.tif"
+    out_path = tmp_path / "out.png"
+    source.save(in_path, icc_profile=SRGB, dpi=(300, 300))
+    export_banded(str(in_path), str(out_path), lambda band, top, size: None,
+                  band_bytes=64 * 3 * 37)
+    assert_round_trip(source, out_path.read_bytes())
@@ -0,0 +1,42 @@
+"""Validation of decoded recipes in watermark_recipe."""
+import pytest
+
+from watermark_recipe import MAX_RECIPE_SIZE, recipe_from_dict
+
+
+@pytest.mark.parametrize("fields", [
+    {"opacity": 200},
+    {"opacity": -50},
+    {"opacity": True},
+    {"size": 0},
+    {"size": MAX_RECIPE_SIZE + 1},
+    {"size": float("nan")},
+    {"size": "large"},
+    {"position": [0.5]},
+    {"position": ["left", 0.5]},
+    {"position": 0.5},
+    {"watermark_type": "video"},
+    {"text": 5},
+    {"grid_mode": "yes"},
+])
+def test_out_of_range_fields_are_rejected(fields):
+    with pytest.raises(ValueError):
+        recipe_from_dict({"version": 1, **fields})
+
+
+def test_max_size_can_be_lowered_for_untrusted_recipes():
+    data = {"version": 1, "watermark_type": "image", "size": 1e5}
+    with pytest.raises(ValueError):
+        recipe_from_dict(data)
+    data["size"] = 2000
+    assert recipe_from_dict(data).settings.size == 2000
+    with pytest.raises(ValueError):
+        recipe_from_dict(data, max_size=1000)
+
+
+def test_valid_fields_are_kept():
+    recipe = recipe_from_dict({"version": 1, "watermark_type": "text", "text": "Hello", "opacity": 0,
+                               "size": 0.5, "grid_mode": True, "position": [0, 1]})
+    assert recipe.settings.opacity == 0
+    assert recipe.settings.size == 0.5
+    assert recipe.settings.position == (0, 1)
@@ -0,0 +1,574 @@
+"""Headless render engine for the Siris Watermarker.
+
+Nothing in this module touches Tk: a render takes an immutable
+WatermarkSettings record plus the base and watermark images and returns a
+new composited image, so the same code serves the GUI preview, exports and
+display-less batch runs.
+
+Base images are used in their own mode: RGBA bases are alpha-composited,
+and RGB bases have the RGBA watermark blended in with its alpha as the mask,
+so an opaque photo never needs an alpha channel of its own.
+"""
+import os
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from functools import lru_cache
+
+from PIL import Image, ImageDraw, ImageFont
+
+
+@dataclass(frozen=True)
+class WatermarkSettings:
+    """Immutable snapshot of every control that affects a render."""
+    watermark_type: str = "image"  # "image" or "text"
+    text: str = ""
+    include_copyright: bool = False
+    white_text: bool = False
+    opacity: int = 100  # Percent, 0-100
+    size: int = 100  # Percent of the watermark image, or font size for text
+    grid_mode: bool = False
+    position: tuple = (0, 0)
+    draft: bool = False  # Preview only: cheap resampling while a control is held
+
+    @property
+    def display_text(self):
+        """The text that is actually drawn, including the optional © prefix."""
+        if self.include_copyright:
+            return f"© {self.text}"
+        return self.text
+
+    @property
+    def alpha(self):
+        """Opacity converted to the 0-255 range."""
+        return int(self.opacity * 2.55)
+
+    @property
+    def text_color(self):
+        """Text fill colour with the opacity applied."""
+        if self.white_text:
+            return (255, 255, 255, self.alpha)
+        return (0, 0, 0, self.alpha)
+
+    @property
+    def font_size(self):
+        """Size as a whole-pixel font size, at least 1."""
+        return max(1, round(self.size))
+
+    def scaled(self, factor):
+        """The same recipe expressed for an image `factor` times larger.
+
+        Used to replay settings chosen on the low-resolution editing proxy
+        against the full-resolution original.
+        """
+        return replace(
+            self,
+            size=self.size * factor,
+            position=(round(self.position[0] * factor), round(self.position[1] * factor))
+        )
+
+
+# Resampling filters for the final render and for interactive drafts
+FINAL_RESAMPLE = Image.Resampling.LANCZOS
+DRAFT_RESAMPLE = Image.Resampling.NEAREST
+
+
+def scaled_size(image, size_percent):
+    """Pixel size of an image scaled by a percentage, at least 1x1."""
+    factor = size_percent / 100.0
+    return max(1, int(image.width * factor)), max(1, int(image.height * factor))
+
+
+class SpriteCache:
+    """Bounded LRU of ready-to-paste watermark sprites.
+
+    Entries are bounded both by count and by total pixel bytes, so a handful
+    of huge logos cannot pin gigabytes of memory. Keys start with id() of the
+    source image; the source is kept alongside the sprite so a recycled id
+    can never return a sprite built from a different image.
+    """
+
+    def __init__(self, max_entries=16, max_bytes=256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, source, key, build):
+        """Return the sprite for (source, *key), calling build() on a miss."""
+        full_key = (id(source),) + tuple(key)
+        entry = self._entries.get(full_key)
+        if entry is not None and entry[0] is source:
+            self._entries.move_to_end(full_key)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        sprite = build()
+        if entry is not None:
+            self._discard(full_key)
+        self._entries[full_key] = (source, sprite)
+        self._bytes += _image_bytes(sprite)
+
+        # Evict least recently used entries, but always keep the newest one
+        while len(self._entries) > 1 and (
+            len(self._entries) > self.max_entries or self._bytes > self.max_bytes
+        ):
+            self._discard(next(iter(self._entries)))
+            self.evictions += 1
+        return sprite
+
+    def _discard(self, full_key):
+        source, sprite = self._entries.pop(full_key)
+        self._bytes -= _image_bytes(sprite)
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self):
+        """Counters for monitoring cache effectiveness."""
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+@lru_cache(maxsize=256)
+def opacity_table(alpha):
+    """256-entry lookup table that scales an alpha channel to `alpha` (0-255).
+
+    Rounds the same way Image.point() does when given a function, so results
+    are identical to the old per-render lambda.
+    """
+    return tuple(round(p * (alpha / 255)) for p in range(256))
+
+
+def apply_opacity(image, alpha):
+    """Return a copy of an RGBA image with its alpha channel scaled to `alpha`."""
+    faded = image.copy()
+    if alpha < 255:
+        faded.putalpha(image.getchannel("A").point(opacity_table(alpha)))
+    return faded
+
+
+def _image_bytes(sprite):
+    if isinstance(sprite, tuple):
+        sprite = sprite[0]  # Text sprites are cached together with their offset
+    return sprite.width * sprite.height * len(sprite.getbands())
+
+
+# Fonts tried in order when no font path is configured; Pillow searches the
+# system font directories for bare file names
+DEFAULT_FONTS = ("arial.ttf", "Arial.ttf", "DejaVuSans.ttf", "LiberationSans-Regular.ttf")
+
+
+class FontRegistry:
+    """Resolves the watermark font once and keeps an LRU of loaded faces.
+
+    The font path comes from the `font_path` argument, then the
+    SIRIS_WATERMARK_FONT environment variable, then DEFAULT_FONTS. If none
+    of them can be opened, Pillow's built-in scalable font is used so the
+    size slider keeps working on machines without Arial.
+    """
+
+    def __init__(self, font_path=None, max_entries=32):
+        self.font_path = font_path or os.environ.get("SIRIS_WATERMARK_FONT")
+        self.max_entries = max_entries
+        self._faces = OrderedDict()
+        self._resolved = False
+        self._path = None
+
+    def resolve(self):
+        """The font file that will be used, or None for Pillow's default font."""
+        if not self._resolved:
+            candidates = (self.font_path,) if self.font_path else DEFAULT_FONTS
+            for candidate in candidates:
+                try:
+                    ImageFont.truetype(candidate, 10)
+                except IOError:
+                    continue
+                self._path = candidate
+                break
+            self._resolved = True
+        return self._path
+
+    def get(self, size):
+        """FreeType face for the resolved font at the given pixel size."""
+        path = self.resolve()
+        key = (path, size)
+        font = self._faces.get(key)
+        if font is not None:
+            self._faces.move_to_end(key)
+            return font
+
+        if path:
+            font = ImageFont.truetype(path, size)
+        else:
+            font = ImageFont.load_default(size)
+        self._faces[key] = font
+        if len(self._faces) > self.max_entries:
+            self._faces.popitem(last=False)
+        return font
+
+
+class WatermarkRenderer:
+    """Composites image and text watermarks onto a base image."""
+
+    def __init__(self, fonts=None, sprite_cache=None, layer_cache=None):
+        self.fonts = fonts if fonts is not None else FontRegistry()
+        self.sprites = sprite_cache if sprite_cache is not None else SpriteCache()
+        # Full-canvas grid overlays are large, so only a few are kept
+        if layer_cache is None:
+            layer_cache = SpriteCache(max_entries=4, max_bytes=512 * 1024 * 1024)
+        self.grid_layers = layer_cache
+
+    def render(self, settings, base_image, watermark_image=None):
+        """Return a new image with the watermark described by settings applied."""
+        if settings.watermark_type == "image":
+            if watermark_image is None:
+                # Nothing to apply until a watermark image has been loaded
+                return base_image.copy()
+            return self.render_image_watermark(settings, base_image, watermark_image)
+        if settings.watermark_type == "text":
+            return self.render_text_watermark(settings, base_image)
+        raise ValueError(f"Unknown watermark type: {settings.watermark_type!r}")
+
+    def image_sprite(self, settings, watermark_image):
+        """Scaled watermark with the opacity applied, shared via the sprite cache.
+
+        The returned image is cached and must not be modified by the caller.
+        """
+        resample = DRAFT_RESAMPLE if settings.draft else FINAL_RESAMPLE
+
+        # The resized watermark is cached on its own, so opacity scrubbing
+        # only has to re-run the alpha lookup table
+        watermark_resized = self.sprites.get(
+            watermark_image,
+            (settings.size, None, resample),
+            lambda: watermark_image.resize(scaled_size(watermark_image, settings.size), resample)
+        )
+        return self.sprites.get(
+            watermark_image,
+            (settings.size, settings.alpha, resample),
+            lambda: apply_opacity(watermark_resized, settings.alpha)
+        )
+
+    def clamp_position(self, position, base_size, sprite_size):
+        """Keep a watermark of sprite_size fully inside the base image."""
+        return (
+            max(0, min(position[0], base_size[0] - sprite_size[0])),
+            max(0, min(position[1], base_size[1] - sprite_size[1]))
+        )
+
+    def image_position(self, settings, base_size, watermark_image):
+        """Where the single image watermark ends up after clamping."""
+        return self.clamp_position(
+            settings.position, base_size, scaled_size(watermark_image, settings.size)
+        )
+
+    def render_image_watermark(self, settings, base_image, watermark_image):
+        base_image_display = base_image.copy()
+
+        if settings.grid_mode:
+            layer = self.grid_layer(settings, base_image.size, watermark_image)
+            if layer is not None:
+                base_image_display.paste(layer, (0, 0), layer)
+        else:
+            # Single watermark mode - Place one watermark at the current position
+            self.composite_single(base_image_display, settings, watermark_image)
+
+        return base_image_display
+
+    def render_band(self, settings, band, top, image_size, watermark_image=None):
+        """Draw the watermark onto band in place.
+
+        band holds full-width rows of an image of image_size, starting at row
+        top. Blending works pixel by pixel, so each band comes out exactly
+        like the same rows of render() on the whole image, while nothing
+        larger than a band is ever allocated.
+        """
+        if settings.watermark_type not in ("image", "text"):
+            raise ValueError(f"Unknown watermark type: {settings.watermark_type!r}")
+        if settings.watermark_type == "image" and watermark_image is None:
+            return
+        if not settings.grid_mode:
+            self.composite_single(band, settings, watermark_image, top, image_size)
+            return
+        layer = self.grid_layer(settings, band.size, watermark_image, top, image_size)
+        if layer is None:
+            return
+        if settings.watermark_type == "image":
+            band.paste(layer, (0, 0), layer)
+        else:
+            blend_layer(band, layer)
+
+    def text_sprite(self, settings):
+        """Text rendered into an image the size of its bounding box.
+
+        Returns (sprite, offset), where offset is where the sprite's top-left
+        corner sits relative to the text origin. Cached by text, font, size
+        and colour (which carries the opacity); the sprite must not be
+        modified by the caller.
+        """
+        text = settings.display_text
+        font_size = settings.font_size
+        fill_color = settings.text_color
+        return self.sprites.get(
+            None,
+            ("text", text, self.fonts.resolve(), font_size, fill_color),
+            lambda: self._build_text_sprite(text, self.fonts.get(font_size), fill_color)
+        )
+
+    def _build_text_sprite(self, text, font, fill_color):
+        # Get the bounding box of the text to size the sprite
+        left, top, right, bottom = font.getbbox(text)
+        sprite = Image.new("RGBA", (max(0, right - left), max(0, bottom - top)), (255, 255, 255, 0))
+        ImageDraw.Draw(sprite).text((-left, -top), text, font=font, fill=fill_color)
+        return sprite, (left, top)
+
+    def render_text_watermark(self, settings, base_image):
+        base_image_display = base_image.copy()
+
+        if settings.grid_mode:
+            layer = self.grid_layer(settings, base_image.size)
+            if layer is not None:
+                blend_layer(base_image_display, layer)
+        else:
+            # Single watermark mode - Place text at the current position
+            self.composite_single(base_image_display, settings)
+
+        return base_image_display
+
+    def grid_layer(self, settings, size, watermark_image=None, top=0, image_size=None):
+        """Transparent layer of `size` holding the checkered grid of watermarks.
+
+        Image watermarks sit on the even cells and text on the odd ones, with
+        cells twice the sprite size. Returns None when the sprite is empty.
+        A non-zero top gives the rows of a grid over an image of image_size
+        starting at that row, for rendering in bands.
+
+        The layer only depends on the watermark, its size and opacity and the
+        canvas size, so it is cached independently of the base image and one
+        layer serves every same-sized image. It must not be modified.
+        """
+        if settings.watermark_type == "image":
+            source = watermark_image
+            key = ("image", settings.size, settings.alpha, settings.draft, size)
+            sprite, offset, odd_cells = self.image_sprite(settings, watermark_image), (0, 0), False
+        else:
+            source = None
+            key = ("text", settings.display_text, self.fonts.resolve(), settings.font_size,
+                   settings.text_color, size)
+            (sprite, offset), odd_cells = self.text_sprite(settings), True
+        if sprite.width == 0 or sprite.height == 0:
+            return None
+        image_size = image_size or size
+        # Only cells starting inside the image are drawn, and the text offset may
+        # push their sprites past the cell edges
+        cells_size = (-(-image_size[0] // (sprite.width * 2)) * sprite.width * 2,
+                      -(-image_size[1] // (sprite.height * 2)) * sprite.height * 2)
+        if top - offset[1] >= 0 and top - offset[1] + size[1] <= cells_size[1]:
+            # Away from the first and last cell rows the pattern repeats every
+            # four sprite heights, so bands in the same phase share a layer
+            band_key = ("phase", (top - offset[1]) % (sprite.height * 4))
+        else:
+            band_key = ("edge", top, image_size[1])
+        return self.grid_layers.get(
+            source, key + band_key,
+            lambda: grid_pattern(checker_tile(sprite, odd_cells), size, offset, cells_size, top)
+        )
+
+    def watermark_box(self, settings, base_size, watermark_image=None):
+        """Bounding box (left, top, right, bottom) of a single watermark.
+
+        Returns None in grid mode or when there is nothing to draw.
+        """
+        if settings.grid_mode:
+            return None
+        if settings.watermark_type == "image":
+            if watermark_image is None:
+                return None
+            sprite_size = scaled_size(watermark_image, settings.size)
+            x, y = self.clamp_position(settings.position, base_size, sprite_size)
+        else:
+            sprite, (offset_x, offset_y) = self.text_sprite(settings)
+            sprite_size = sprite.size
+            x, y = settings.position[0] + offset_x, settings.position[1] + offset_y
+        return clip_box((x, y, x + sprite_size[0], y + sprite_size[1]), base_size)
+
+    def composite_single(self, image, settings, watermark_image=None, top=0, image_size=None):
+        """Draw the single (non-grid) watermark onto image in place.
+
+        When image is a band of a larger image, top is the row it starts at
+        and image_size the size of the whole image.
+        """
+        image_size = image_size or image.size
+        if settings.watermark_type == "image":
+            if watermark_image is None:
+                return
+            sprite = self.image_sprite(settings, watermark_image)
+            x, y = self.clamp_position(settings.position, image_size, sprite.size)
+            image.paste(sprite, (x, y - top), sprite)
+        else:
+            sprite, (offset_x, offset_y) = self.text_sprite(settings)
+            x, y = settings.position
+            composite_at(image, sprite, (x + offset_x, y + offset_y - top))
+
+
+class DisplayBuffer:
+    """Persistent composited frame that is patched in place between renders.
+
+    While only single-watermark settings change (dragging, sliders, text
+    edits) just the union of the previous and new watermark boxes is
+    restored from the base and recomposited, so the cost scales with the
+    watermark size rather than the image size. Anything else (a new base
+    or watermark image, grid mode) falls back to a full render.
+    """
+
+    def __init__(self, renderer):
+        self.renderer = renderer
+        self.image = None
+        self._base = None
+        self._watermark = None
+        self._settings = None
+        self._box = None
+
+    def update(self, settings, base_image, watermark_image=None):
+        """Bring the frame up to date and return the box that changed.
+
+        Returns None when nothing changed since the previous update.
+        """
+        same_sources = (
+            self.image is not None
+            and base_image is self._base
+            and watermark_image is self._watermark
+        )
+        if same_sources and settings == self._settings:
+            return None
+
+        box = self.renderer.watermark_box(settings, base_image.size, watermark_image)
+        if same_sources and not settings.grid_mode and not self._settings.grid_mode:
+            dirty = union_box(self._box, box)
+            if dirty is not None:
+                # Restore the old watermark area from the base, then redraw
+                self.image.paste(base_image.crop(dirty), dirty[:2])
+                self.renderer.composite_single(self.image, settings, watermark_image)
+        else:
+            self.image = self.renderer.render(settings, base_image, watermark_image)
+            dirty = (0, 0) + base_image.size
+
+        self._base = base_image
+        self._watermark = watermark_image
+        self._settings = settings
+        self._box = box
+        return dirty
+
+
+def checker_tile(sprite, odd_cells=False):
+    """One period of the checkered grid: 2x2 cells, each twice the sprite size.
+
+    The sprite is placed at the corner of the two cells whose (column + row)
+    parity matches odd_cells.
+    """
+    spacing_x = sprite.width * 2  # Set spacing between watermarks
+    spacing_y = sprite.height * 2
+    tile = Image.new("RGBA", (spacing_x * 2, spacing_y * 2), (0, 0, 0, 0))
+    if odd_cells:
+        cells = ((spacing_x, 0), (0, spacing_y))
+    else:
+        cells = ((0, 0), (spacing_x, spacing_y))
+    for x, y in cells:
+        tile.paste(sprite, (x, y))
+    return tile
+
+
+def grid_pattern(tile, size, offset, cells_size, top=0):
+    """Layer of `size` with the tiled grid shifted by offset, from row top.
+
+    Only the cells inside cells_size (whole cells from the image's top-left
+    corner) are drawn, like a loop over the cells of the image would: a
+    sprite shifted past the edge of its tile is not wrapped around, and no
+    sprite comes in from cells beyond the image.
+    """
+    offset_x, offset_y = offset
+    # The part of the unshifted pattern that lands on the layer
+    left, upper = max(0, -offset_x), max(0, top - offset_y)
+    right = min(cells_size[0], size[0] - offset_x)
+    lower = min(cells_size[1], top - offset_y + size[1])
+    layer = Image.new(tile.mode, size, (0, 0, 0, 0))
+    if left < right and upper < lower:
+        pattern = tile_pattern(tile, (right, lower - upper), upper)
+        layer.paste(pattern.crop((left, 0, right, lower - upper)), (left + offset_x, upper + offset_y - top))
+    return layer
+
+
+def tile_pattern(tile, size, top=0):
+    """Cover an image of `size` with repeats of tile.
+
+    With a non-zero top the pattern starts that many rows into the tile.
+
+    One full-width band is built by doubling the covered width with each
+    paste (a logarithmic number of copies), then stamped down the image
+    once per tile row. Either way every call moves a large block, instead
+    of one paste per watermark.
+    """
+    band = Image.new(tile.mode, (size[0], tile.height), (0, 0, 0, 0))
+    band.paste(tile, (0, 0))
+    width = tile.width
+    while width < size[0]:
+        band.paste(band.crop((0, 0, width, tile.height)), (width, 0))
+        width *= 2
+
+    layer = Image.new(tile.mode, size, (0, 0, 0, 0))
+    for y in range(-(top % tile.height), size[1], tile.height):
+        layer.paste(band, (0, y))
+    return layer
+
+
+def clip_box(box, size):
+    """Clip a (left, top, right, bottom) box to an image size, or None if empty."""
+    left, top = max(0, box[0]), max(0, box[1])
+    right, bottom = min(size[0], box[2]), min(size[1], box[3])
+    if left >= right or top >= bottom:
+        return None
+    return (left, top, right, bottom)
+
+
+def union_box(a, b):
+    """Smallest box containing both a and b; either may be None."""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+def blend_layer(base_image, layer):
+    """Composite an RGBA layer the size of base_image onto it in place."""
+    if base_image.mode == "RGBA":
+        base_image.alpha_composite(layer)
+    else:
+        base_image.paste(layer, (0, 0), layer)
+
+
+def composite_at(base_image, sprite, position):
+    """Alpha-composite sprite onto base_image in place, clipped to its bounds.
+
+    Bases without alpha get the sprite blended in with its alpha as the mask.
+    """
+    x, y = position
+    if base_image.mode != "RGBA":
+        base_image.paste(sprite, (x, y), sprite)  # paste() does its own clipping
+        return
+    left, top = max(0, -x), max(0, -y)
+    right = min(sprite.width, base_image.width - x)
+    bottom = min(sprite.height, base_image.height - y)
+    if left >= right or top >= bottom:
+        return
+    base_image.alpha_composite(sprite, (x + left, y + top), (left, top, right, bottom))
@@ -0,0 +1,222 @@
+"""Export profiles: named encoder settings per output format.
+
+Every format has the same three profiles, so a profile can be picked by
+throughput budget without knowing the format:
+
+    fast       cheapest encode, larger files
+    balanced   the default; Pillow's own encoder settings where they cost no speed
+    smallest   smallest files, at the cost of encode time
+
+The JPEG profiles decode to identical pixels (only Huffman optimisation and
+progressive scans differ) and the PNG ones are lossless, so for those two
+formats a profile never changes what the image looks like. Every WebP
+profile keeps quality 80 and varies only the encoder effort, which buys
+WebP little: method 6 saves under 0.2% over balanced for twice the time.
+Smaller WebP files need a lower quality, which no profile chooses for you.
+
+PNG fast always goes through PngWriter with the Up filter. balanced keeps
+Pillow's adaptive encoder, which picks a filter per row, whenever only one
+thread compresses (batch, watch, serve and the benchmark's default); with
+more threads (the GUI) it goes through PngWriter with the Average filter,
+because per-row filter choice does not split across threads. Compared with
+Pillow at the same level, Average is 16% larger on the reference
+screenshot and 7% larger on the photo, but 5% smaller on the gradient and
+about 40% smaller on noisy JPEG-decoded images. smallest encodes with both
+Pillow's optimising encoder and PngWriter at level 9 and keeps the smaller
+file, so it is never larger than balanced.
+
+Reference numbers from `siris_watermark.py benchmark` with one thread on a
+watermarked set of a 2160x1431 photo, a 1300x900 screenshot and a 4000x3000
+gradient-and-noise image (16.3 MP in total), with sizes relative to balanced.
+The pillow rows are a plain Image.save with Pillow's defaults; for PNG it
+runs the same encoder as balanced, so the time gap between them is noise:
+
+    format  profile    ms/MP   bytes
+    PNG     pillow       294       0
+    PNG     fast          57    +31%
+    PNG     balanced     342       0
+    PNG     smallest    4682     -7%
+    JPEG    pillow         5     +4%
+    JPEG    fast           5     +4%
+    JPEG    balanced      11       0
+    JPEG    smallest      27     -3%
+    WEBP    pillow       151       0
+    WEBP    fast          42     +5%
+    WEBP    balanced     146       0
+    WEBP    smallest     354       0
+
+With --threads 4 (on a single core, so no parallel speed-up) PNG balanced
+switches to PngWriter: 293 ms/MP and 1% smaller than pillow on this set.
+
+Run the benchmark on your own images before choosing; photos, scans and
+screenshots trade off differently.
+"""
+import io
+import os
+import time
+
+from PIL import Image
+
+from watermark_io import PNG_COLOR_TYPES, save_png
+
+PROFILE_NAMES = ("fast", "balanced", "smallest")
+DEFAULT_PROFILE = "balanced"
+
+# Pillow save() options per format and profile. png_filter is either one of
+# PngWriter's filters or "adaptive": Pillow's encoder choosing a filter per
+# row, which PngWriter (one filter for every row) replaces with
+# PARALLEL_PNG_FILTER when it has several threads to compress on.
+EXPORT_PROFILES = {
+    "PNG": {
+        "fast": {"compress_level": 1, "png_filter": "up"},
+        "balanced": {"compress_level": 6, "png_filter": "adaptive"},
+        "smallest": {"compress_level": 9, "png_filter": "adaptive", "optimize": True},
+    },
+    "JPEG": {
+        "fast": {"quality": 75, "subsampling": "4:2:0"},
+        "balanced": {"quality": 75, "subsampling": "4:2:0", "optimize": True},
+        "smallest": {"quality": 75, "subsampling": "4:2:0", "optimize": True, "progressive": True},
+    },
+    "WEBP": {
+        "fast": {"quality": 80, "method": 0},
+        "balanced": {"quality": 80, "method": 4},
+        "smallest": {"quality": 80, "method": 6},
+    },
+    "BMP": {"fast": {}, "balanced": {}, "smallest": {}},
+}
+PARALLEL_PNG_FILTER = "average"
+
+# Name of the benchmark row for Pillow's save() with no options
+REFERENCE_PROFILE = "pillow"
+
+# Modes each format can store; anything else is converted before saving
+FORMAT_MODES = {
+    "PNG": ("1", "L", "LA", "P", "RGB", "RGBA", "I", "I;16"),
+    "JPEG": ("L", "RGB", "CMYK"),
+    "BMP": ("1", "L", "P", "RGB"),
+    "WEBP": ("RGB", "RGBA"),
+}
+
+
+def format_for_path(path, default="PNG"):
+    """Pillow format name for a file name's extension."""
+    return Image.registered_extensions().get(os.path.splitext(path)[1].lower(), default)
+
+
+def export_options(image_format, profile=DEFAULT_PROFILE):
+    """Pillow save() options for a format and profile name; raises ValueError if unknown."""
+    if profile not in PROFILE_NAMES:
+        raise ValueError(f"Unknown export profile {profile!r}, expected one of {', '.join(PROFILE_NAMES)}")
+    return dict(EXPORT_PROFILES.get(image_format.upper(), {}).get(profile, {}))
+
+
+def streamed_png_options(profile=DEFAULT_PROFILE):
+    """PngWriter options (compress_level, png_filter) for a profile, for banded exports."""
+    options = export_options("PNG", profile)
+    options.pop("optimize", None)  # Banded exports cannot use Pillow's whole-image search
+    if options["png_filter"] == "adaptive":
+        options["png_filter"] = PARALLEL_PNG_FILTER
+    return options
+
+
+def prepare_for_format(image, image_format):
+    """Convert image to a mode the format can store, dropping alpha where it must."""
+    modes = FORMAT_MODES.get(image_format.upper())
+    if modes is None or image.mode in modes:
+        return image
+    has_alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+    if has_alpha and "RGBA" in modes:
+        return image.convert("RGBA")
+    if image.mode in ("1", "LA", "I", "I;16", "F") and "L" in modes:
+        return image.convert("L")
+    return image.convert("RGB")
+
+
+def save_export(image, target, image_format=None, profile=DEFAULT_PROFILE, threads=None):
+    """Encode image to target (a path or binary file) with an export profile.
+
+    The format comes from the file extension unless given. PNGs are
+    compressed on `threads` threads (all cores by default) where the profile
+    and thread count allow; see _save_png_profile. The source's ICC profile
+    and dpi are kept whichever encoder runs.
+    """
+    if image_format is None:
+        image_format = format_for_path(target)
+    image_format = image_format.upper()
+    options = export_options(image_format, profile)
+    image = prepare_for_format(image, image_format)
+    if image_format == "PNG" and image.mode in PNG_COLOR_TYPES:
+        _save_png_profile(image, target, options, threads)
+    else:
+        _save_with_pillow(image, target, image_format, options)
+
+
+def _save_with_pillow(image, target, image_format, options):
+    options = dict(options)
+    options.pop("png_filter", None)
+    for key in ("icc_profile", "dpi"):
+        if image.info.get(key):
+            options.setdefault(key, image.info[key])
+    image.save(target, image_format, **options)
+
+
+def _save_png_profile(image, target, options, threads):
+    """Save a PNG in a mode PngWriter can write with a PNG profile's options.
+
+    A fixed png_filter always goes through PngWriter. "adaptive" uses
+    Pillow's encoder on a single thread, where PngWriter would gain nothing,
+    and PngWriter with PARALLEL_PNG_FILTER otherwise. `smallest` encodes
+    both ways and keeps the smaller file: Pillow's per-row search usually
+    wins, but on noisy images (decoded JPEGs, film grain) a single Average
+    filter can be a third smaller.
+    """
+    png_filter = options["png_filter"]
+    if png_filter != "adaptive":
+        save_png(image, target, options["compress_level"], threads, png_filter)
+    elif options.get("optimize"):
+        candidates = []
+        for encode in (
+            lambda buffer: _save_with_pillow(image, buffer, "PNG", options),
+            lambda buffer: save_png(image, buffer, options["compress_level"], threads, PARALLEL_PNG_FILTER),
+        ):
+            buffer = io.BytesIO()
+            encode(buffer)
+            candidates.append(buffer.getvalue())
+        data = min(candidates, key=len)
+        if isinstance(target, (str, os.PathLike)):
+            with open(target, "wb") as out_file:
+                out_file.write(data)
+        else:
+            target.write(data)
+    elif (threads or os.cpu_count() or 1) == 1:
+        _save_with_pillow(image, target, "PNG", options)
+    else:
+        save_png(image, target, options["compress_level"], threads, PARALLEL_PNG_FILTER)
+
+
+def benchmark_profiles(images, formats=("PNG", "JPEG", "WEBP"), repeat=1, threads=1):
+    """Encode every image with every profile; yields (format, profile, seconds, bytes).
+
+    seconds is the best of `repeat` runs summed over the images, bytes the
+    total encoded size. Each format starts with a REFERENCE_PROFILE row:
+    Pillow's save() with its own defaults, for comparison.
+    """
+    for image_format in formats:
+        for profile in (REFERENCE_PROFILE,) + PROFILE_NAMES:
+            seconds = 0.0
+            size = 0
+            for image in images:
+                best = None
+                for _ in range(repeat):
+                    buffer = io.BytesIO()
+                    start = time.perf_counter()
+                    if profile == REFERENCE_PROFILE:
+                        prepare_for_format(image, image_format).save(buffer, image_format)
+                    else:
+                        save_export(image, buffer, image_format, profile, threads)
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                seconds += best
+                size += buffer.tell()
+            yield image_format, profile, seconds, size
+
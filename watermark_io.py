@@ -0,0 +1,403 @@
+"""Image loading and saving helpers for the Siris Watermarker."""
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageChops
+
+# Images with at least this many pixels are exported band by band when the
+# output is a PNG, so peak memory depends on the band size, not the image
+LARGE_IMAGE_PIXELS = 64 * 1000 * 1000
+BAND_BYTES = 16 * 1024 * 1024  # RGBA bytes per band in a banded export
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_COLOR_TYPES = {"L": (0, 1), "RGB": (2, 3), "RGBA": (6, 4)}  # Mode: (colour type, bytes per pixel)
+# PNG filter types PngWriter can apply to every row; Paeth does not vectorise with ImageChops
+PNG_FILTERS = {"none": 0, "sub": 1, "up": 2, "average": 3}
+PNG_BLOCK_BYTES = 1024 * 1024  # Filtered bytes compressed as one job by a PngWriter thread
+DEFLATE_WINDOW = 32 * 1024  # How far back deflate matches reach, and so the dictionary size
+
+
+NATIVE_MODES = ("RGB", "RGBA")  # Modes the compositor blends the watermark into directly
+
+
+def native_mode(image):
+    """Mode image is composited in: RGBA if it has any transparency, RGB otherwise."""
+    if image.mode in NATIVE_MODES:
+        return image.mode
+    has_alpha = image.mode in ("LA", "La", "PA", "RGBa") or "transparency" in image.info
+    return "RGBA" if has_alpha else "RGB"
+
+
+def to_native(image):
+    """image in its native_mode(), converted only when it is in some other mode.
+
+    Opaque photos stay RGB instead of gaining an alpha channel that would
+    cost a third more memory and have to be stripped again to save a JPEG.
+    The pixels are loaded, so the result outlives the file it came from.
+    """
+    mode = native_mode(image)
+    if image.mode == mode:
+        image.load()
+        return image
+    return image.convert(mode)
+
+
+def open_preview(path, size):
+    """Decode an image just large enough to fit inside size, in its native mode.
+
+    The image is shrunk before it is fully decoded: thumbnail() asks the
+    decoder for a draft first, so JPEGs are scaled in the DCT domain (by 1/2,
+    1/4 or 1/8) and a 50MP photo never gets decoded at full resolution just
+    to show a small preview. path may also be an open binary file. Returns
+    (preview, full-resolution size).
+    """
+    with Image.open(path) as image:
+        full_size = image.size
+        image.thumbnail(size)
+        preview = to_native(image)
+    return preview, full_size
+
+
+def open_full(path):
+    """Decode the whole image at full resolution, in its native mode."""
+    with Image.open(path) as image:
+        return to_native(image)
+
+
+def use_banded_export(image_size, out_path):
+    """True when an image of image_size should be written to out_path in bands."""
+    return image_size[0] * image_size[1] >= LARGE_IMAGE_PIXELS and out_path.lower().endswith(".png")
+
+
+def _raw_row_reader(image):
+    """Function reading rows [top, bottom) straight from an uncompressed file.
+
+    Returns None unless the whole image is one raw tile (BMP, PPM, PGM and
+    uncompressed TIFF) in a mode the bands can be built from.
+    """
+    if len(image.tile) != 1 or image.mode not in PNG_COLOR_TYPES:
+        return None
+    codec, extents, offset, args = image.tile[0][:4]
+    width, height = image.size
+    if codec != "raw" or tuple(extents) != (0, 0, width, height):
+        return None
+    if isinstance(args, str):
+        args = (args,)
+    rawmode, stride, orientation = (tuple(args) + (0, 1))[:3]
+    if orientation not in (1, -1):
+        return None
+    if stride == 0:
+        # Unpadded rows; let Pillow work out how many bytes one row packs to
+        try:
+            stride = len(Image.new(image.mode, (width, 1)).tobytes("raw", rawmode))
+        except ValueError:
+            return None
+
+    def read_rows(top, bottom):
+        rows = bottom - top
+        # Bottom-up files (most BMPs) store the last row first
+        first = top if orientation == 1 else height - bottom
+        image.fp.seek(offset + first * stride)
+        data = image.fp.read(rows * stride)
+        if len(data) < rows * stride:
+            raise OSError("image file is truncated")
+        return Image.frombytes(image.mode, (width, rows), data, "raw", rawmode, stride, orientation)
+
+    return read_rows
+
+
+def iter_bands(image, band_height):
+    """Yield (top, band) for consecutive full-width bands of an open image.
+
+    Bands are in the image's native_mode(). Uncompressed files are read band
+    by band straight from disk, so only one band is ever decoded. Compressed
+    formats cannot be decoded part way, so they are decoded once and, if
+    their mode needs converting, converted one band at a time.
+    """
+    width, height = image.size
+    mode = native_mode(image)
+    read_rows = _raw_row_reader(image)
+    if read_rows is None:
+        image.load()
+    for top in range(0, height, band_height):
+        bottom = min(height, top + band_height)
+        if read_rows is not None:
+            band = read_rows(top, bottom)
+        else:
+            band = image.crop((0, top, width, bottom))
+        yield top, band if band.mode == mode else band.convert(mode)
+
+
+class PngWriter:
+    """Writes a PNG to an open binary file one band of rows at a time.
+
+    Every row uses the same filter (png_filter, one of PNG_FILTERS), computed
+    for a whole band at once with ImageChops. The filtered rows are cut into blocks that a thread pool
+    compresses in parallel, the way pigz does: each block is raw deflate
+    primed with the last 32 KB of the block before it (so matches still
+    reach back across block boundaries) and ends in a sync flush, so the
+    blocks join into one ordinary zlib stream. zlib releases the GIL while
+    compressing, so encode time scales with cores. Compressed blocks are
+    written out in order as IDAT chunks as soon as they are ready, with a
+    bounded number in flight. Bands must arrive top to bottom and add up to
+    the image height.
+
+    icc_profile and dpi (usually taken from the source image's info) are
+    written as iCCP and pHYs chunks, so colour management and print size
+    survive the export the same way they do with Pillow's encoder.
+    """
+
+    def __init__(self, file, size, mode="RGBA", compress_level=6, threads=None, icc_profile=None, dpi=None,
+                 png_filter="up"):
+        if mode not in PNG_COLOR_TYPES:
+            raise ValueError(f"Cannot stream PNGs in mode {mode}")
+        if png_filter not in PNG_FILTERS:
+            raise ValueError(f"Unknown PNG filter {png_filter!r}, expected one of {', '.join(PNG_FILTERS)}")
+        self.file = file
+        self.size = size
+        self.mode = mode
+        self.compress_level = compress_level
+        self.png_filter = png_filter
+        self.rows = 0
+        color_type, self._bytes_per_pixel = PNG_COLOR_TYPES[mode]
+        self._previous = None  # Last row of the previous band, which Up and Average refer to
+        self._threads = threads or os.cpu_count() or 1
+        self._executor = ThreadPoolExecutor(max_workers=self._threads, thread_name_prefix="png-deflate")
+        self._blocks = deque()  # Futures of compressed blocks, in stream order
+        self._pending = bytearray()  # Filtered rows not yet handed to a block
+        self._dictionary = b""
+        self._adler = zlib.adler32(b"")
+        self._header = zlib.compress(b"", compress_level)[:2]  # zlib header for this level
+        self.file.write(PNG_SIGNATURE)
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", size[0], size[1], 8, color_type, 0, 0, 0))
+        # Ancillary chunks that describe the pixels must come before the first IDAT
+        if icc_profile:
+            # Profile name, null separator, compression method 0 (deflate)
+            self._chunk(b"iCCP", b"ICC Profile\0\0" + zlib.compress(icc_profile))
+        if dpi:
+            # Pixels per metre, unit 1 (metre), rounded like Pillow's encoder
+            self._chunk(b"pHYs", struct.pack(
+                ">IIB", int(dpi[0] / 0.0254 + 0.5), int(dpi[1] / 0.0254 + 0.5), 1
+            ))
+
+    def write(self, band):
+        """Append band, a full-width image in the writer's mode, below the rows written so far."""
+        if band.mode != self.mode or band.width != self.size[0]:
+            raise ValueError(f"Expected a {self.mode} band {self.size[0]} pixels wide")
+        if self.rows + band.height > self.size[1]:
+            raise ValueError("More rows than the image height")
+        self._pending += self._filter_rows(band)
+        self._previous = band.crop((0, band.height - 1, band.width, band.height))
+        self.rows += band.height
+        while len(self._pending) >= PNG_BLOCK_BYTES:
+            self._submit(bytes(self._pending[:PNG_BLOCK_BYTES]))
+            del self._pending[:PNG_BLOCK_BYTES]
+
+    def _filter_rows(self, band):
+        # Each filter subtracts a prediction from every byte, modulo 256. The
+        # predictions are whole images: the pixel to the left (Sub), the pixel
+        # above (Up) or the floor of their mean (Average), zero past the edges.
+        if self.png_filter == "none":
+            filtered = band.tobytes()
+        else:
+            left = above = None
+            if self.png_filter in ("sub", "average"):
+                left = Image.new(band.mode, band.size)
+                left.paste(band.crop((0, 0, band.width - 1, band.height)), (1, 0))
+            if self.png_filter in ("up", "average"):
+                above = Image.new(band.mode, band.size)
+                if self._previous is not None:
+                    above.paste(self._previous, (0, 0))
+                above.paste(band.crop((0, 0, band.width, band.height - 1)), (0, 1))
+            if self.png_filter == "average":
+                prediction = ImageChops.add(left, above, scale=2.0)  # Truncates, as the filter floors
+            else:
+                prediction = left if above is None else above
+            filtered = ImageChops.subtract_modulo(band, prediction).tobytes()
+        filtered = memoryview(filtered)
+
+        # Prefix every row with its filter type byte
+        filter_type = PNG_FILTERS[self.png_filter]
+        stride = band.width * self._bytes_per_pixel
+        rows = bytearray((stride + 1) * band.height)
+        for row in range(band.height):
+            start = row * (stride + 1)
+            rows[start] = filter_type
+            rows[start + 1:start + 1 + stride] = filtered[row * stride:(row + 1) * stride]
+        return rows
+
+    def _submit(self, block, last=False):
+        self._adler = zlib.adler32(block, self._adler)
+        self._blocks.append(self._executor.submit(
+            _deflate_block, block, self._dictionary, self.compress_level, last
+        ))
+        self._dictionary = block[-DEFLATE_WINDOW:]
+        # Keep every thread busy without queueing up the whole image
+        while len(self._blocks) > self._threads * 2:
+            self._idat(self._blocks.popleft().result())
+
+    def close(self):
+        """Finish the zlib stream and the file; the caller closes the file itself."""
+        if self.rows != self.size[1]:
+            raise ValueError(f"Only {self.rows} of {self.size[1]} rows were written")
+        self._submit(bytes(self._pending), last=True)
+        self._pending = bytearray()
+        while self._blocks:
+            self._idat(self._blocks.popleft().result())
+        self._idat(struct.pack(">I", self._adler))
+        self._chunk(b"IEND", b"")
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._executor.shutdown(cancel_futures=True)
+
+    def _idat(self, data):
+        # The zlib header goes in front of the first block
+        data, self._header = self._header + data, b""
+        if data:
+            self._chunk(b"IDAT", data)
+
+    def _chunk(self, kind, data):
+        self.file.write(struct.pack(">I", len(data)))
+        self.file.write(kind)
+        self.file.write(data)
+        self.file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+
+def _deflate_block(data, dictionary, compress_level, last):
+    """Raw deflate of one block of the stream; runs on a PngWriter thread."""
+    if dictionary:
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    # A sync flush ends the block on a byte boundary without ending the stream
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def save_png(image, target, compress_level=6, threads=None, png_filter="up"):
+    """Save image as a PNG to a path or binary file, compressing on several threads.
+
+    Modes PngWriter cannot write are left to Pillow's encoder, which picks
+    its own filters. The ICC profile and dpi in image.info are kept either way.
+    """
+    if image.mode not in PNG_COLOR_TYPES:
+        # Pillow keeps the ICC profile from image.info but only writes dpi when asked
+        options = {"dpi": image.info["dpi"]} if image.info.get("dpi") else {}
+        image.save(target, "PNG", compress_level=compress_level, **options)
+        return
+    if isinstance(target, (str, os.PathLike)):
+        with open(target, "wb") as out_file:
+            save_png(image, out_file, compress_level, threads, png_filter)
+        return
+    rows = max(1, BAND_BYTES // (image.width * 4))
+    with PngWriter(target, image.size, image.mode, compress_level, threads,
+                   image.info.get("icc_profile"), image.info.get("dpi"), png_filter) as writer:
+        for top in range(0, image.height, rows):
+            writer.write(image.crop((0, top, image.width, min(image.height, top + rows))))
+
+
+def export_banded(source, out_path, draw, band_bytes=BAND_BYTES, compress_level=6, png_filter="up", threads=None):
+    """Write source (a path or open binary file) to out_path as a PNG, band by band.
+
+    draw(band, top, image_size) is called on every band before it is
+    encoded and should composite the watermark onto it in place, e.g.
+    WatermarkRenderer.render_band with the settings bound. Rendering and
+    encoding only ever hold a few bands. For uncompressed sources (BMP, PPM,
+    raw TIFF) that bounds peak memory however large the image is; JPEG, PNG
+    and other compressed sources are still decoded once in full first, so
+    they save the copies a whole-image render and encode would make, not the
+    decoded image itself. threads is the PngWriter thread count, all cores
+    by default.
+    """
+    with Image.open(source) as image:
+        size = image.size
+        band_height = max(1, band_bytes // (size[0] * 4))
+        mode = native_mode(image)
+        with open(out_path, "wb") as out_file, PngWriter(
+            out_file, size, mode, compress_level, threads, icc_profile=image.info.get("icc_profile"),
+            dpi=image.info.get("dpi"), png_filter=png_filter
+        ) as writer:
+            for top, band in iter_bands(image, band_height):
+                draw(band, top, size)
+                writer.write(band)
+
+
+class ImageHandle:
+    """A loaded image whose pixels are only decoded when something needs them.
+
+    Opening a handle reads the header alone, so path, format, size, mode and
+    EXIF are available immediately. preview() decodes a small proxy on demand
+    and keeps it; full() decodes at full resolution, which only an export
+    needs, and release() drops that decode again. The file stays open for the
+    handle's lifetime, so it still exports after being renamed or replaced
+    on disk. Images that are opened and discarded never get decoded in full.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            with Image.open(self._file) as image:
+                self.format = image.format
+                self.size = image.size
+                self.mode = image.mode
+                self.exif = image.getexif()
+        except Exception:
+            self._file.close()
+            raise
+        self._preview = None
+        self._preview_size = None
+        self._full = None
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def _rewound(self):
+        if self._file.closed:
+            raise ValueError(f"Image handle for {self.path} is closed")
+        self._file.seek(0)
+        return self._file
+
+    def preview(self, size):
+        """Proxy that fits inside size, decoded once per requested size."""
+        if self._preview is None or self._preview_size != size:
+            self._preview, _ = open_preview(self._rewound(), size)
+            self._preview_size = size
+        return self._preview
+
+    def full(self):
+        """Full-resolution image in its native mode; kept until release() is called."""
+        if self._full is None:
+            self._full = open_full(self._rewound())
+        return self._full
+
+    def export_banded(self, out_path, draw, band_bytes=BAND_BYTES, compress_level=6, png_filter="up",
+                      threads=None):
+        """Export band by band without a full decode; see export_banded()."""
+        export_banded(self._rewound(), out_path, draw, band_bytes, compress_level, png_filter, threads)
+
+    def release(self):
+        """Drop the full-resolution decode, keeping the preview and the file."""
+        self._full = None
+
+    def close(self):
+        """Drop every decode and close the file."""
+        self._preview = None
+        self._full = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,171 @@
+"""Per-process watermarking jobs shared by the headless front ends.
+
+Worker processes call init_worker() once, which loads the recipe, the
+watermark image and a renderer whose font and sprite caches then stay warm
+for every file that process handles.
+"""
+import io
+import os
+import time
+import warnings
+from functools import partial
+
+from PIL import Image
+
+from watermark_engine import WatermarkRenderer
+from watermark_export import DEFAULT_PROFILE, format_for_path, save_export, streamed_png_options
+from watermark_io import export_banded, to_native, use_banded_export
+from watermark_recipe import load_recipe, recipe_from_dict
+
+# Same formats the GUI can load
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+# Largest size (percent, or font pixels) a recipe sent with a request may ask for
+REQUEST_MAX_SIZE = 1000
+
+
+def is_image_file(path):
+    return path.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def find_images(input_dir):
+    """Image files directly inside input_dir, sorted by name."""
+    return sorted(
+        entry.path for entry in os.scandir(input_dir)
+        if entry.is_file() and is_image_file(entry.name)
+    )
+
+
+def validate_recipe(path):
+    """Load a recipe and check its watermark image exists; raises OSError or ValueError."""
+    recipe = load_recipe(path)
+    if recipe.watermark_image and not os.path.isfile(recipe.watermark_image):
+        raise ValueError(f"watermark image not found: {recipe.watermark_image}")
+    return recipe
+
+
+def save_output(image, path, profile=DEFAULT_PROFILE):
+    """Save a rendered image in the format given by the file extension.
+
+    Workers already run one per core, so PNGs are compressed on one thread.
+    """
+    save_export(image, path, format_for_path(path), profile, threads=1)
+
+
+# Per-process state, set up once by init_worker
+_worker = {}
+
+
+def set_max_pixels(max_pixels):
+    """Replace Pillow's decompression bomb limit for this process.
+
+    Images with more than max_pixels pixels then fail to open; 0 removes the
+    limit. Pillow's default (about 179 MP) rejects gigapixel maps and
+    orthomosaics before they can reach the banded export.
+    """
+    if max_pixels:
+        Image.MAX_IMAGE_PIXELS = max_pixels
+        # Pillow only warns between the limit and twice the limit
+        warnings.simplefilter("error", Image.DecompressionBombWarning)
+    else:
+        Image.MAX_IMAGE_PIXELS = None
+
+
+def init_worker(recipe_path, profile=DEFAULT_PROFILE, max_pixels=None):
+    if max_pixels is not None:
+        set_max_pixels(max_pixels)
+    recipe = load_recipe(recipe_path)
+    _worker["recipe"] = recipe
+    _worker["profile"] = profile
+    _worker["watermark"] = Image.open(recipe.watermark_image).convert("RGBA") if recipe.watermark_image else None
+    _worker["renderer"] = WatermarkRenderer()
+
+
+def warm_up(hold=0.0):
+    """Render a tiny image so fonts and sprites are loaded before real work arrives.
+
+    hold keeps the worker busy for a moment, so submitting one warm-up per
+    worker makes the pool start all of its processes.
+    """
+    render_image(Image.new("RGBA", (64, 64)))
+    time.sleep(hold)
+    return os.getpid()
+
+
+def render_image(base_image, recipe=None):
+    """Apply a recipe (the worker's by default) to an already decoded image."""
+    recipe = recipe or _worker["recipe"]
+    settings = recipe.settings_for(base_image.size)
+    return _worker["renderer"].render(settings, base_image, _worker["watermark"])
+
+
+def watermark_bytes(data, recipe_data=None, output_format=None, profile=None):
+    """Watermark an encoded image held in memory.
+
+    recipe_data optionally overrides the worker's recipe for this image; it
+    cannot name its own watermark image, the worker's one is always used.
+    profile overrides the worker's export profile the same way. Returns
+    (encoded bytes, MIME type, {stage: milliseconds}).
+    """
+    recipe = None
+    if recipe_data is not None:
+        if isinstance(recipe_data, dict) and recipe_data.get("watermark_image"):
+            raise ValueError("a request recipe cannot name a watermark image")
+        recipe = recipe_from_dict(recipe_data, max_size=REQUEST_MAX_SIZE)
+
+    timings = {}
+    start = time.perf_counter()
+    with Image.open(io.BytesIO(data)) as image:
+        source_format = image.format
+        base_image = to_native(image)
+    decoded = time.perf_counter()
+    timings["decode"] = (decoded - start) * 1000
+
+    result = render_image(base_image, recipe)
+    rendered = time.perf_counter()
+    timings["render"] = (rendered - decoded) * 1000
+
+    if output_format:
+        # Accept extensions (jpg, tif) as well as Pillow's names (JPEG, TIFF)
+        requested = output_format
+        output_format = format_for_path("x." + requested.lower(), None)
+        if output_format not in Image.SAVE:
+            raise ValueError(f"Unknown output format {requested!r}")
+    else:
+        output_format = source_format or "PNG"
+    buffer = io.BytesIO()
+    save_export(result, buffer, output_format, profile or _worker["profile"], threads=1)
+    timings["encode"] = (time.perf_counter() - rendered) * 1000
+    return buffer.getvalue(), Image.MIME.get(output_format, "application/octet-stream"), timings
+
+
+def watermark_file(in_path, out_path):
+    """Render one file in a worker process; returns (in_path, error or None, seconds).
+
+    The output is written under a temporary name and renamed into place, so
+    anything watching the output directory never sees a partial file.
+    Very large images going to PNG are rendered and encoded in bands.
+    """
+    start = time.perf_counter()
+    directory, name = os.path.split(out_path)
+    stem, extension = os.path.splitext(name)
+    partial_path = os.path.join(directory, f".{stem}.partial{extension}")
+    try:
+        with Image.open(in_path) as image:
+            size = image.size  # Only the header has been read so far
+            banded = use_banded_export(size, out_path)
+            if not banded:
+                base_image = to_native(image)
+        if banded:
+            settings = _worker["recipe"].settings_for(size)
+            draw = partial(_worker["renderer"].render_band, settings, watermark_image=_worker["watermark"])
+            # One thread, like save_output: workers already run one per core
+            export_banded(in_path, partial_path, draw, threads=1, **streamed_png_options(_worker["profile"]))
+        else:
+            save_output(render_image(base_image), partial_path, _worker["profile"])
+        os.replace(partial_path, out_path)
+    except Exception as error:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        return in_path, f"{type(error).__name__}: {error}", time.perf_counter() - start
+    return in_path, None, time.perf_counter() - start
@@ -0,0 +1,237 @@
+"""Staged batch pipeline: read -> decode -> render -> encode -> write.
+
+Each stage has its own pool of workers and its own executor, and stages are
+connected by bounded asyncio queues. Disk I/O for one image therefore
+overlaps with decoding, rendering and encoding of others, and a slow stage
+applies back-pressure instead of letting memory grow. Pillow releases the
+GIL for decoding, compositing and encoding, so thread pools are enough to
+keep several cores busy.
+
+Per-stage busy time and sampled queue depths are collected so the report
+points at the bottleneck stage.
+"""
+import asyncio
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from PIL import Image
+
+from watermark_engine import WatermarkRenderer
+from watermark_export import DEFAULT_PROFILE, format_for_path, save_export
+from watermark_io import to_native
+from watermark_jobs import find_images
+from watermark_recipe import load_recipe
+
+STAGES = ("read", "decode", "render", "encode", "write")
+
+
+@dataclass
+class StageStats:
+    """Counters for one pipeline stage."""
+    name: str
+    workers: int
+    items: int = 0
+    errors: int = 0
+    busy: float = 0.0  # Seconds spent working, excluding waits on the queues
+
+    def utilization(self, elapsed):
+        """Fraction of the stage's worker capacity that was in use."""
+        if elapsed <= 0:
+            return 0.0
+        return self.busy / (elapsed * self.workers)
+
+
+@dataclass
+class QueueStats:
+    """Sampled depth of the queue feeding a stage."""
+    name: str
+    capacity: int
+    samples: list = field(default_factory=list)
+
+    @property
+    def mean_depth(self):
+        return sum(self.samples) / len(self.samples) if self.samples else 0.0
+
+    @property
+    def max_depth(self):
+        return max(self.samples, default=0)
+
+
+@dataclass
+class _Item:
+    in_path: str
+    out_path: str
+    payload: object = None
+    image_format: str = None
+
+
+class WatermarkPipeline:
+    """Runs a recipe over many files with every stage working concurrently."""
+
+    def __init__(self, recipe, concurrency=None, queue_size=8, sample_interval=0.05, profile=DEFAULT_PROFILE):
+        self.recipe = recipe
+        self.profile = profile
+        self.watermark = Image.open(recipe.watermark_image).convert("RGBA") if recipe.watermark_image else None
+        cpus = os.cpu_count() or 1
+        self.concurrency = {"read": 2, "decode": cpus, "render": cpus, "encode": cpus, "write": 2}
+        self.concurrency.update(concurrency or {})
+        self.queue_size = queue_size
+        self.sample_interval = sample_interval
+        self.stage_stats = {name: StageStats(name, self.concurrency[name]) for name in STAGES}
+        self.queue_stats = {name: QueueStats(name, queue_size) for name in STAGES}
+        self.failures = []
+        self.elapsed = 0.0
+        # Renderer caches are not thread-safe, so every render thread gets its own
+        self._local = threading.local()
+
+    # -- stage work, run in the stage executors --
+
+    def _read(self, item):
+        with open(item.in_path, "rb") as image_file:
+            item.payload = image_file.read()
+        return item
+
+    def _decode(self, item):
+        with Image.open(io.BytesIO(item.payload)) as image:
+            item.payload = to_native(image)
+        return item
+
+    def _render(self, item):
+        renderer = getattr(self._local, "renderer", None)
+        if renderer is None:
+            renderer = self._local.renderer = WatermarkRenderer()
+        settings = self.recipe.settings_for(item.payload.size)
+        item.payload = renderer.render(settings, item.payload, self.watermark)
+        return item
+
+    def _encode(self, item):
+        buffer = io.BytesIO()
+        # The encode stage already runs one thread per core
+        save_export(item.payload, buffer, format_for_path(item.out_path), self.profile, threads=1)
+        item.payload = buffer.getvalue()
+        return item
+
+    def _write(self, item):
+        # Write under a temporary name so readers never see a partial file
+        directory, name = os.path.split(item.out_path)
+        partial_path = os.path.join(directory, f".{name}.partial")
+        with open(partial_path, "wb") as out_file:
+            out_file.write(item.payload)
+        os.replace(partial_path, item.out_path)
+        item.payload = None
+        return item
+
+    # -- orchestration --
+
+    async def run(self, jobs):
+        """Process (in_path, out_path) pairs; returns the number of failures."""
+        work = {
+            "read": self._read, "decode": self._decode, "render": self._render,
+            "encode": self._encode, "write": self._write,
+        }
+        executors = {
+            name: ThreadPoolExecutor(max_workers=self.concurrency[name], thread_name_prefix=f"pipeline-{name}")
+            for name in STAGES
+        }
+        queues = {name: asyncio.Queue(maxsize=self.queue_size) for name in STAGES}
+        start = time.perf_counter()
+        sampler = asyncio.create_task(self._sample_queues(queues))
+        try:
+            stages = []
+            for index, name in enumerate(STAGES):
+                outbox = queues[STAGES[index + 1]] if index + 1 < len(STAGES) else None
+                next_workers = self.concurrency[STAGES[index + 1]] if outbox is not None else 0
+                stages.append(self._run_stage(
+                    name, queues[name], outbox, next_workers, work[name], executors[name]
+                ))
+            await asyncio.gather(self._feed(jobs, queues["read"]), *stages)
+        finally:
+            sampler.cancel()
+            for executor in executors.values():
+                executor.shutdown(wait=True)
+        self.elapsed = time.perf_counter() - start
+        return len(self.failures)
+
+    async def _feed(self, jobs, queue):
+        for in_path, out_path in jobs:
+            await queue.put(_Item(in_path, out_path))
+        for _ in range(self.concurrency["read"]):
+            await queue.put(None)  # One stop marker per reader
+
+    async def _run_stage(self, name, inbox, outbox, next_workers, work, executor):
+        loop = asyncio.get_running_loop()
+        stats = self.stage_stats[name]
+
+        async def worker():
+            while True:
+                item = await inbox.get()
+                if item is None:
+                    return
+                started = time.perf_counter()
+                try:
+                    item = await loop.run_in_executor(executor, work, item)
+                except Exception as error:
+                    stats.errors += 1
+                    self.failures.append((item.in_path, name, f"{type(error).__name__}: {error}"))
+                    continue
+                finally:
+                    stats.busy += time.perf_counter() - started
+                stats.items += 1
+                if outbox is not None:
+                    await outbox.put(item)
+
+        await asyncio.gather(*(worker() for _ in range(stats.workers)))
+        # Every worker of this stage is done; tell the next stage to stop too
+        for _ in range(next_workers):
+            await outbox.put(None)
+
+    async def _sample_queues(self, queues):
+        while True:
+            for name, queue in queues.items():
+                self.queue_stats[name].samples.append(queue.qsize())
+            await asyncio.sleep(self.sample_interval)
+
+    def report(self):
+        """Human readable per-stage utilization and queue depths."""
+        lines = [
+            f"{'stage':<8}{'workers':>8}{'items':>8}{'errors':>8}{'busy s':>9}{'ms/item':>9}"
+            f"{'util':>7}{'queue avg':>11}{'queue max':>11}"
+        ]
+        for name in STAGES:
+            stats = self.stage_stats[name]
+            queue = self.queue_stats[name]
+            per_item = stats.busy / stats.items * 1000 if stats.items else 0.0
+            lines.append(
+                f"{name:<8}{stats.workers:>8}{stats.items:>8}{stats.errors:>8}{stats.busy:>9.2f}"
+                f"{per_item:>9.1f}{stats.utilization(self.elapsed):>7.0%}"
+                f"{queue.mean_depth:>11.1f}{queue.max_depth:>8}/{queue.capacity}"
+            )
+        bottleneck = max(STAGES, key=lambda name: self.stage_stats[name].utilization(self.elapsed))
+        lines.append(f"Bottleneck: {bottleneck} stage")
+        return "\n".join(lines)
+
+
+def run_pipeline(args):
+    recipe = load_recipe(args.recipe)
+    os.makedirs(args.output_dir, exist_ok=True)
+    inputs = find_images(args.input_dir)
+    if not inputs:
+        print(f"No images found in {args.input_dir}")
+        return 0
+    jobs = [(path, os.path.join(args.output_dir, os.path.basename(path))) for path in inputs]
+
+    concurrency = {name: getattr(args, name) for name in STAGES if getattr(args, name)}
+    pipeline = WatermarkPipeline(recipe, concurrency, queue_size=args.queue_size, profile=args.profile)
+    failures = asyncio.run(pipeline.run(jobs))
+    for in_path, stage, error in pipeline.failures:
+        print(f"FAILED {in_path} in {stage}: {error}")
+
+    done = len(jobs) - failures
+    print(f"Watermarked {done}/{len(jobs)} images in {pipeline.elapsed:.1f}s "
+          f"({len(jobs) / pipeline.elapsed:.1f} images/s)")
+    print(pipeline.report())
+    return 1 if failures else 0
@@ -0,0 +1,144 @@
+"""Versioned recipe files describing a complete watermark configuration.
+
+A recipe is what the GUI controls hold, written to JSON so that batch runs,
+the hot-folder watcher and the HTTP service render exactly what was set up
+interactively:
+
+    {
+      "version": 1,
+      "watermark_type": "image",
+      "text": "",
+      "include_copyright": false,
+      "white_text": false,
+      "opacity": 60,
+      "size": 250.0,
+      "grid_mode": false,
+      "position": [0.05, 0.9],
+      "watermark_image": "logo.png"
+    }
+
+The position is a fraction of the image width and height, so one recipe fits
+images of any resolution. The size is in full-resolution units: percent of
+the watermark image, or the font size in pixels for text. The watermark
+image path is stored relative to the recipe file.
+"""
+import json
+import math
+import os
+from dataclasses import dataclass, fields, replace
+
+from watermark_engine import WatermarkSettings
+
+RECIPE_VERSION = 1
+
+# Settings fields stored in a recipe; draft is a preview-only flag
+RECIPE_FIELDS = tuple(field.name for field in fields(WatermarkSettings) if field.name != "draft")
+
+# Largest size in a recipe file: percent of the watermark image, or font size
+# in pixels. The GUI's 200% slider on its 400 pixel proxy reaches this for an
+# original 100000 pixels wide; callers handling untrusted recipes pass less.
+MAX_RECIPE_SIZE = 50000
+
+
+@dataclass(frozen=True)
+class Recipe:
+    """Watermark settings with a normalized position, plus the watermark image path.
+
+    Recipes are immutable and hashable, so they can key caches directly.
+    """
+    settings: WatermarkSettings
+    watermark_image: str = None  # Absolute path, or None for text-only recipes
+
+    @classmethod
+    def from_settings(cls, settings, image_size, watermark_image=None):
+        """Capture settings made on an image of image_size (in full-resolution units)."""
+        position = (settings.position[0] / image_size[0], settings.position[1] / image_size[1])
+        return cls(replace(settings, position=position, draft=False), watermark_image)
+
+    def settings_for(self, image_size):
+        """Settings with the position expressed in pixels of an image of image_size."""
+        x, y = self.settings.position
+        return replace(self.settings, position=(round(x * image_size[0]), round(y * image_size[1])))
+
+
+def load_recipe(path):
+    """Read a recipe file, raising ValueError if it is not a valid recipe."""
+    with open(path, encoding="utf-8") as recipe_file:
+        data = json.load(recipe_file)
+    return recipe_from_dict(data, base_dir=os.path.dirname(os.path.abspath(path)))
+
+
+def recipe_from_dict(data, base_dir=".", max_size=MAX_RECIPE_SIZE):
+    """Build a Recipe from decoded JSON; relative image paths resolve against base_dir.
+
+    Raises ValueError for fields of the wrong type or out of range, including
+    a size above max_size.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("A recipe must be a JSON object")
+    data = dict(data)
+    version = data.pop("version", None)
+    if version != RECIPE_VERSION:
+        raise ValueError(f"Unsupported recipe version {version!r}, expected {RECIPE_VERSION}")
+
+    watermark_image = data.pop("watermark_image", None)
+    if watermark_image:
+        watermark_image = os.path.normpath(os.path.join(base_dir, watermark_image))
+
+    unknown = set(data) - set(RECIPE_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown recipe fields: {', '.join(sorted(unknown))}")
+    _check_fields(data, max_size)
+    if "position" in data:
+        data["position"] = tuple(data["position"])
+    return Recipe(WatermarkSettings(**data), watermark_image)
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+def _check_fields(data, max_size):
+    """Check the types and ranges of decoded recipe fields; raises ValueError.
+
+    Recipes also arrive with HTTP requests, so nothing may be trusted: an
+    out-of-range size alone can ask a worker for gigabytes of sprite.
+    """
+    if "watermark_type" in data and data["watermark_type"] not in ("image", "text"):
+        raise ValueError(f"watermark_type must be \"image\" or \"text\", not {data['watermark_type']!r}")
+    if "text" in data and not isinstance(data["text"], str):
+        raise ValueError("text must be a string")
+    for name in ("include_copyright", "white_text", "grid_mode"):
+        if name in data and not isinstance(data[name], bool):
+            raise ValueError(f"{name} must be true or false")
+    if "opacity" in data and not (_is_number(data["opacity"]) and 0 <= data["opacity"] <= 100):
+        raise ValueError(f"opacity must be a number from 0 to 100, not {data['opacity']!r}")
+    if "size" in data and not (_is_number(data["size"]) and 0 < data["size"] <= max_size):
+        raise ValueError(f"size must be a number above 0 and at most {max_size}, not {data['size']!r}")
+    if "position" in data:
+        position = data["position"]
+        if not (isinstance(position, (list, tuple)) and len(position) == 2 and all(map(_is_number, position))):
+            raise ValueError(f"position must be two numbers, not {position!r}")
+
+
+def recipe_to_dict(recipe, base_dir="."):
+    """Encode a Recipe as a JSON-ready dict; the image path is made relative to base_dir."""
+    data = {"version": RECIPE_VERSION}
+    for name in RECIPE_FIELDS:
+        value = getattr(recipe.settings, name)
+        data[name] = list(value) if isinstance(value, tuple) else value
+    if recipe.watermark_image:
+        try:
+            data["watermark_image"] = os.path.relpath(recipe.watermark_image, base_dir)
+        except ValueError:
+            # Different drive on Windows; fall back to the absolute path
+            data["watermark_image"] = os.path.abspath(recipe.watermark_image)
+    return data
+
+
+def save_recipe(recipe, path):
+    """Write a recipe file."""
+    data = recipe_to_dict(recipe, base_dir=os.path.dirname(os.path.abspath(path)))
+    with open(path, "w", encoding="utf-8") as recipe_file:
+        json.dump(data, recipe_file, indent=2, ensure_ascii=False)
+        recipe_file.write("\n")
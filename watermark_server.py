@@ -0,0 +1,243 @@
+"""Local HTTP watermarking service and a load-test client for it.
+
+    POST /watermark        body: encoded image, response: watermarked image
+    GET  /health           liveness check
+
+The recipe given at startup applies to every request. A request can
+override the settings by sending a recipe as JSON in the X-Watermark-Recipe
+header; the server's watermark image is always used, and the recipe's size
+is capped at watermark_jobs.REQUEST_MAX_SIZE. ?format=png|jpg|tif|...
+picks the output format, otherwise the input format is kept, and
+?profile=fast|balanced|smallest overrides the server's export profile.
+
+Rendering runs in a pool of worker processes that are started and warmed
+up before the server accepts connections, so requests never pay for
+interpreter, Pillow or font start-up. Every response carries a
+Server-Timing header with queue, decode, render and encode durations. If a
+worker dies (for example, killed for running out of memory), that request
+gets a 500 and the pool is replaced, so later requests are served again.
+"""
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from watermark_jobs import init_worker, warm_up, watermark_bytes
+
+
+class WatermarkServer(ThreadingHTTPServer):
+    """HTTP server that hands images to a pool of pre-warmed render workers.
+
+    start_workers() returns a new, warmed-up executor. It is called again to
+    replace the pool when a worker dies, e.g. killed for running out of
+    memory, because a ProcessPoolExecutor fails every later job once that
+    happens.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, start_workers, max_body=100 * 1024 * 1024, quiet=False):
+        self.start_workers = start_workers
+        self.executor = start_workers()  # Warm before accepting connections
+        self._restart_lock = threading.Lock()
+        try:
+            super().__init__(address, WatermarkRequestHandler)
+        except OSError:
+            self.executor.shutdown()
+            raise
+        self.max_body = max_body
+        self.quiet = quiet
+
+    def restart_workers(self, broken):
+        """Replace the broken executor, unless another request already did."""
+        with self._restart_lock:
+            if self.executor is broken:
+                broken.shutdown(wait=False, cancel_futures=True)
+                self.executor = self.start_workers()
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown()
+
+
+class WatermarkRequestHandler(BaseHTTPRequestHandler):
+    server_version = "SirisWatermark/1"
+    protocol_version = "HTTP/1.1"  # Keep-alive, so load tests measure rendering, not TCP setup
+
+    def do_GET(self):
+        if urlsplit(self.path).path == "/health":
+            self.send_text(200, "ok")
+        else:
+            self.send_text(404, "not found")
+
+    def do_POST(self):
+        start = time.perf_counter()
+        url = urlsplit(self.path)
+        # Replies sent before the body is read must close the connection,
+        # or the unread body would be parsed as the next request
+        if url.path != "/watermark":
+            self.send_text(404, "not found", close=True)
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            self.send_text(400, "Content-Length must be a number", close=True)
+            return
+        if length <= 0:
+            self.send_text(400, "request body must contain an image", close=True)
+            return
+        if length > self.server.max_body:
+            self.send_text(413, f"image larger than {self.server.max_body} bytes", close=True)
+            return
+        data = self.rfile.read(length)
+
+        executor = self.server.executor
+        try:
+            recipe_header = self.headers.get("X-Watermark-Recipe")
+            recipe_data = json.loads(recipe_header) if recipe_header else None
+            query = parse_qs(url.query)
+            output_format = query.get("format", [None])[0]
+            profile = query.get("profile", [None])[0]
+            received = time.perf_counter()
+            body, content_type, timings = executor.submit(
+                watermark_bytes, data, recipe_data, output_format, profile
+            ).result()
+        except BrokenProcessPool as error:
+            self.server.restart_workers(executor)
+            self.send_text(500, f"render worker died, workers restarted: {error}")
+            return
+        except (OSError, ValueError, TypeError) as error:
+            # Undecodable images, bad recipes and unknown formats are the client's fault
+            self.send_text(400, f"{type(error).__name__}: {error}")
+            return
+        except Exception as error:
+            self.send_text(500, f"{type(error).__name__}: {error}")
+            return
+
+        total = (time.perf_counter() - start) * 1000
+        worker_time = sum(timings.values())
+        timings["queue"] = max(0.0, (time.perf_counter() - received) * 1000 - worker_time)
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Server-Timing", ", ".join(
+            f"{stage};dur={duration:.2f}" for stage, duration in timings.items()
+        ))
+        self.send_header("X-Total-Time-Ms", f"{total:.2f}")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_text(self, status, message, close=False):
+        body = (message + "\n").encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        if close:
+            self.close_connection = True
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+def start_workers(recipe_path, profile, jobs):
+    """A process pool with every worker started and warmed up."""
+    executor = ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(recipe_path, profile))
+    list(executor.map(warm_up, [0.2] * jobs))
+    return executor
+
+
+def run_serve(args):
+    jobs = args.jobs or os.cpu_count()
+    server = WatermarkServer(
+        (args.host, args.port), partial(start_workers, args.recipe, args.profile, jobs),
+        max_body=args.max_body_mb * 1024 * 1024, quiet=args.quiet
+    )
+    print(f"Serving on http://{args.host}:{server.server_port}/watermark with {jobs} warm workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping")
+    finally:
+        server.server_close()
+    return 0
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def run_loadtest(args):
+    """Send the same image repeatedly from several connections and report latency."""
+    with open(args.image, "rb") as image_file:
+        data = image_file.read()
+    url = urlsplit(args.url)
+    path = url.path or "/watermark"
+    if url.query:
+        path += "?" + url.query
+    headers = {"Content-Type": "application/octet-stream"}
+    if args.recipe_header:
+        with open(args.recipe_header, encoding="utf-8") as recipe_file:
+            headers["X-Watermark-Recipe"] = json.dumps(json.load(recipe_file))
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    counter = iter(range(args.requests))
+
+    def client():
+        connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=args.timeout)
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    break
+            start = time.perf_counter()
+            try:
+                connection.request("POST", path, body=data, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException) as error:
+                connection.close()
+                connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=args.timeout)
+                status = f"{type(error).__name__}: {error}"
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                if status == 200:
+                    latencies.append(elapsed)
+                else:
+                    errors.append(status)
+        connection.close()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print(f"Requests:    {len(latencies)} ok, {len(errors)} failed in {elapsed:.2f}s")
+    print(f"Throughput:  {len(latencies) / elapsed:.1f} images/s at concurrency {args.concurrency}")
+    if latencies:
+        print(f"Latency ms:  mean {sum(latencies) / len(latencies):.1f}  p50 {percentile(latencies, 0.50):.1f}  "
+              f"p90 {percentile(latencies, 0.90):.1f}  p99 {percentile(latencies, 0.99):.1f}  "
+              f"max {latencies[-1]:.1f}")
+    if errors:
+        print(f"First error: {errors[0]}", file=sys.stderr)
+    return 1 if errors else 0
@@ -0,0 +1,102 @@
+"""Hot-folder mode: watermark images as they are dropped into a directory.
+
+The directory is polled rather than watched through OS notifications, so it
+works the same on network shares and without extra dependencies. A file is
+only picked up once it has not been modified for a settle period and its
+size stopped changing, which skips files that are still being copied in.
+"""
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from watermark_jobs import init_worker, is_image_file, watermark_file
+
+
+class HotFolder:
+    """Tracks an input directory and reports files that are ready to process."""
+
+    def __init__(self, input_dir, output_dir, settle=2.0):
+        self.input_dir = input_dir
+        self.output_dir = output_dir
+        self.settle = settle
+        self._seen = {}  # path -> (size, mtime) at the previous poll
+        self._handled = {}  # path -> (size, mtime) that was queued
+
+    def output_path(self, path):
+        return os.path.join(self.output_dir, os.path.basename(path))
+
+    def poll(self, now=None):
+        """Return new or changed files that have settled, oldest first."""
+        now = time.time() if now is None else now
+        ready = []
+        seen = {}
+        for entry in os.scandir(self.input_dir):
+            if not entry.is_file() or entry.name.startswith(".") or not is_image_file(entry.name):
+                continue
+            stat = entry.stat()
+            signature = (stat.st_size, stat.st_mtime)
+            seen[entry.path] = signature
+            if self._handled.get(entry.path) == signature:
+                continue
+            if stat.st_size == 0 or now - stat.st_mtime < self.settle:
+                continue  # Still being written
+            if entry.path in self._seen and self._seen[entry.path] != signature:
+                continue  # Changed since the last poll, wait for another round
+            if self._is_up_to_date(entry.path, stat.st_mtime):
+                self._handled[entry.path] = signature
+                continue
+            self._handled[entry.path] = signature
+            ready.append((stat.st_mtime, entry.path))
+        self._seen = seen
+        # Forget files that were removed so a re-added file is processed again
+        for path in set(self._handled) - set(seen):
+            del self._handled[path]
+        return [path for mtime, path in sorted(ready)]
+
+    def _is_up_to_date(self, path, mtime):
+        """True when an output newer than the input already exists, e.g. after a restart."""
+        try:
+            return os.stat(self.output_path(path)).st_mtime >= mtime
+        except FileNotFoundError:
+            return False
+
+
+def run_watch(args):
+    os.makedirs(args.output_dir, exist_ok=True)
+    folder = HotFolder(args.input_dir, args.output_dir, settle=args.settle)
+    jobs = args.jobs or os.cpu_count()
+    max_in_flight = jobs * 2  # Keeps the queue bounded while every worker stays busy
+    backlog = []
+    in_flight = set()
+    failures = 0
+
+    if not args.once:
+        print(f"Watching {args.input_dir} -> {args.output_dir} with {jobs} workers (Ctrl+C to stop)")
+    with ProcessPoolExecutor(
+        max_workers=jobs, initializer=init_worker, initargs=(args.recipe, args.profile, args.max_pixels)
+    ) as executor:
+        try:
+            while True:
+                backlog.extend(folder.poll())
+                while backlog and len(in_flight) < max_in_flight:
+                    path = backlog.pop(0)
+                    in_flight.add(executor.submit(watermark_file, path, folder.output_path(path)))
+
+                if args.once and not backlog and not in_flight:
+                    break
+                if in_flight:
+                    done, in_flight = wait(in_flight, timeout=args.interval, return_when=FIRST_COMPLETED)
+                else:
+                    done = ()
+                    time.sleep(args.interval)
+                for future in done:
+                    in_path, error, seconds = future.result()
+                    if error:
+                        failures += 1
+                        print(f"FAILED {in_path}: {error}", file=sys.stderr)
+                    else:
+                        print(f"{in_path} ({seconds * 1000:.0f} ms)")
+        except KeyboardInterrupt:
+            print("Stopping")
+    return 1 if failures else 0